@@ -0,0 +1,78 @@
+"""
+QR rendering: the original per-pixel loop vs. the array based
+`QrCodeGenerator.create`. Both outputs are compared pixel for pixel.
+
+Usage, from the repository root (needs settings.py):
+    python -m benchmarks.bench_qr [rounds]
+"""
+import os
+import sys
+import tempfile
+import timeit
+from io import BytesIO
+
+import numpy as np
+import pyqrcode
+from PIL import Image, ImageDraw
+
+from funding.bin.qr import QrCodeGenerator, FilesystemQrStore
+
+ADDRESS = 'WW44Zvkfv76ezeFn5M4ijAdjyCe7dK48bjaFixvyJoeyP1pmkn2MbLugchM8hV6czL4hBhjnKTP4W9HfHyNUqBch2y2R4DT3v'
+
+
+def create_legacy(address, dest, color_from=(210, 83, 200), color_to=(255, 169, 62), image_size=(300, 300)):
+    """The implementation `QrCodeGenerator.create` replaced"""
+    created = pyqrcode.create(address, error='L')
+    buffer = BytesIO()
+    created.png(buffer, scale=14, quiet_zone=2)
+
+    im = Image.open(buffer)
+    im = im.convert("RGBA")
+    im.thumbnail(image_size)
+
+    im_transparent = []
+    for color_point in im.getdata():
+        if sum(color_point[:3]) == 255 * 3:
+            im_transparent.append(color_point)
+        else:
+            im_transparent.append((0, 0, 0, 0))
+    im.putdata(im_transparent)
+
+    gradient = Image.new('RGBA', im.size, color=0)
+    draw = ImageDraw.Draw(gradient)
+    for i, color in enumerate(QrCodeGenerator.gradient_interpolate(color_from, color_to, im.width * 2)):
+        draw.line([(i, 0), (0, i)], tuple(color), width=1)
+
+    Image.alpha_composite(gradient, im).save(dest, quality=25, optimize=True)
+    return dest
+
+
+def encode(address, image_size=(300, 300)):
+    """The part both implementations share"""
+    created = pyqrcode.create(address, error='L')
+    buffer = BytesIO()
+    created.png(buffer, scale=14, quiet_zone=2)
+    Image.open(buffer).convert("RGBA").thumbnail(image_size)
+
+
+def main(rounds=20):
+    with tempfile.TemporaryDirectory() as tmp:
+        qr = QrCodeGenerator(store=FilesystemQrStore(os.path.join(tmp, 'store')))
+        dest_legacy = os.path.join(tmp, 'legacy.png')
+        dest_new = os.path.join(tmp, 'new.png')
+
+        legacy = timeit.timeit(lambda: create_legacy(ADDRESS, dest_legacy), number=rounds) / rounds
+        new = timeit.timeit(lambda: qr.create(ADDRESS, dest=dest_new), number=rounds) / rounds
+        shared = timeit.timeit(lambda: encode(ADDRESS), number=rounds) / rounds
+
+        identical = np.array_equal(np.asarray(Image.open(dest_legacy)), np.asarray(Image.open(dest_new)))
+
+    print(f'legacy: {legacy * 1000:8.2f} ms/image ({(legacy - shared) * 1000:8.2f} ms after QR encoding)')
+    print(f'array:  {new * 1000:8.2f} ms/image ({(new - shared) * 1000:8.2f} ms after QR encoding)')
+    print(f'speedup: {legacy / new:.1f}x overall, {(legacy - shared) / (new - shared):.1f}x after QR encoding')
+    print(f'identical output: {identical}')
+    return 0 if identical else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(*map(int, sys.argv[1:])))
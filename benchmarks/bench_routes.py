@@ -0,0 +1,262 @@
+"""
+Route latency and query counts against a seeded database, with a stub
+JSON-RPC server standing in for wallet-rpc.
+
+Needs settings.py, a local Postgres and Redis. The benchmark database
+(BENCH_PSQL_DB, default `<PSQL_DB>_bench`) is created when missing and
+its tables are dropped and re-seeded on every run; the database from
+settings.py is never touched. SQLite is not supported: the ledger and
+search rely on postgres upserts and text search.
+
+Usage, from the repository root:
+    python -m benchmarks.bench_routes [--proposals 200] [--comments 20] [--users 50]
+                                      [--requests 200] [--cold] [--budgets]
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import settings
+
+ADDRESS_LENGTH = 97
+WORDS = ('wallet', 'marketing', 'miner', 'design', 'node', 'android', 'meme', 'website',
+         'translation', 'audit', 'pool', 'explorer', 'merch', 'conference', 'video')
+
+# query budgets for --budgets, per endpoint, with some headroom over
+# what the routes issue on a cold cache; override QUERY_BUDGETS
+BUDGETS = {
+    'proposals': 10,
+    'proposal': 15,
+    'search': 8,
+    'api_proposals_get': 3,
+    'api_qr_generate': 1,
+}
+
+
+class StubWalletRpc(BaseHTTPRequestHandler):
+    """Answers the wallet-rpc methods `funding.bin.daemon.Daemon` uses,
+    with deterministic data"""
+    payments_per_id = 3
+
+    def do_POST(self):
+        blob = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        method = getattr(self, 'rpc_%s' % blob['method'], None)
+        if method:
+            body = {'jsonrpc': '2.0', 'id': blob['id'], 'result': method(**blob.get('params', {}))}
+        else:
+            body = {'jsonrpc': '2.0', 'id': blob['id'], 'error': {'code': -32601, 'message': 'Method not found'}}
+
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+    def rpc_make_integrated_address(self):
+        payment_id = os.urandom(8).hex()
+        return {'integrated_address': address('integrated', payment_id, length=108),
+                'payment_id': payment_id}
+
+    def rpc_get_bulk_payments(self, payment_ids, min_block_height=0):
+        payments = []
+        for payment_id in payment_ids:
+            for i in range(self.payments_per_id):
+                payments.append({
+                    'payment_id': payment_id,
+                    'tx_hash': hashlib.sha256(f'{payment_id}:{i}'.encode()).hexdigest(),
+                    'amount': (i + 1) * 10 ** 12,
+                    'block_height': max(min_block_height, 1000 + i)
+                })
+        return {'payments': payments}
+
+    def rpc_get_transfer_by_txid(self, txid):
+        return {'transfer': {'txid': txid, 'payment_id': '', 'amount': 10 ** 12, 'height': 0}}
+
+
+def address(*parts, length=ADDRESS_LENGTH):
+    blob = hashlib.sha256(':'.join(map(str, parts)).encode()).hexdigest()
+    return ('Wo' + blob * 4)[:length]
+
+
+def start_stub_rpc():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubWalletRpc)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:%d/json_rpc' % server.server_port
+
+
+def ensure_database(name):
+    import psycopg2
+
+    host, _, port = settings.PSQL_HOST.partition(':')
+    conn = psycopg2.connect(host=host, port=port or 5432, user=settings.PSQL_USER,
+                            password=settings.PSQL_PASS, dbname='postgres')
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute('SELECT 1 FROM pg_database WHERE datname = %s', (name,))
+        if not cur.fetchone():
+            cur.execute('CREATE DATABASE "%s"' % name)
+    conn.close()
+
+
+def seed(db, users, proposals, comments):
+    from funding.bin.render import render, render_key, render_comment
+    from funding.orm import User, Proposal, Comment
+
+    rnd = random.Random(42)
+    _users = []
+    for i in range(users):
+        user = User(username=f'bench{i}', password=None, email=f'bench{i}@example.com')
+        user.admin = i == 0
+        _users.append(user)
+    db.session.add_all(_users)
+    db.session.flush()
+
+    _proposals = []
+    for i in range(proposals):
+        words = rnd.sample(WORDS, 3)
+        content = '#### Why?\n\n%s\n\n#### How much?\n\n%s\n\n> quoted %s\n' % (
+            ' '.join(rnd.choice(WORDS) for _ in range(120)),
+            ' '.join(rnd.choice(WORDS) for _ in range(60)),
+            words[0])
+        p = Proposal(headline='Bench proposal %d: %s' % (i, ' '.join(words)), content=content,
+                     category=settings.FUNDING_CATEGORIES[i % len(settings.FUNDING_CATEGORIES)],
+                     user=rnd.choice(_users))
+        p.html = render(content)
+        p.render_key = render_key(content)
+        p.funds_target = rnd.randint(100, 100000)
+        p.status = 1 + i % 4
+        p.addr_receiving = address('receiving', i)
+        p.payment_id = hashlib.sha256(b'pid%d' % i).hexdigest()[:16]
+        p.addr_donation = address('donation', i, length=108)
+        _proposals.append(p)
+    db.session.add_all(_proposals)
+    db.session.flush()
+
+    for p in _proposals:
+        roots = []
+        for i in range(comments):
+            message = 'comment %d on %d\r\n> %s\r\nsee https://example.com/%d' % (
+                i, p.id, ' '.join(rnd.sample(WORDS, 5)), i)
+            c = Comment(user_id=rnd.choice(_users).id, proposal_id=p.id, message=message,
+                        html=render_comment(message), automated=i % 10 == 9)
+            # a third of the comments reply to an earlier one
+            if roots and i % 3 == 2:
+                c.replied_to = rnd.choice(roots).id
+            db.session.add(c)
+            db.session.flush()
+            if not c.replied_to:
+                roots.append(c)
+    db.session.commit()
+    return _proposals
+
+
+class QueryCounter:
+    def __init__(self, engine):
+        import sqlalchemy as sa
+        self.count = 0
+        sa.event.listen(engine, 'before_cursor_execute', self.before_cursor_execute)
+
+    def before_cursor_execute(self, *args):
+        self.count += 1
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def bench_route(client, cache, counter, urls, requests, cold):
+    latencies, queries, failures = [], [], 0
+    for i in range(requests + 5):
+        url = urls[i % len(urls)]
+        if cold:
+            cache.clear()
+        counter.count = 0
+        start = time.perf_counter()
+        resp = client.get(url)
+        elapsed = time.perf_counter() - start
+        if resp.status_code != 200:
+            failures += 1
+        # the first few requests warm up connections and template caches
+        if i >= 5:
+            latencies.append(elapsed * 1000)
+            queries.append(counter.count)
+    return latencies, queries, failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--proposals', type=int, default=200)
+    parser.add_argument('--comments', type=int, default=20, help='comments per proposal')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=200, help='timed requests per route')
+    parser.add_argument('--cold', action='store_true', help='clear the cache before every request')
+    parser.add_argument('--budgets', action='store_true',
+                        help='fail requests over their query budget (BUDGETS) and log repeated statements')
+    args = parser.parse_args()
+
+    server, rpc_url = start_stub_rpc()
+    settings.PSQL_DB = os.environ.get('BENCH_PSQL_DB', '%s_bench' % settings.PSQL_DB)
+    settings.RPC_LOCATION = rpc_url
+    settings.RPC_USERNAME = ''
+    settings.MICROCACHE_TTL = 0
+    settings.DEBUG = False
+    settings.QUERY_TRACKER = settings.QUERY_TRACKER_STRICT = args.budgets
+    if args.budgets:
+        settings.QUERY_BUDGETS = dict(settings.QUERY_BUDGETS, **BUDGETS)
+    ensure_database(settings.PSQL_DB)
+
+    from funding.factory import create_app
+    app = create_app()
+    from funding.factory import db, cache
+    from funding.bin.ledger import index_payments
+
+    db.drop_all()
+    db.create_all()
+    cache.clear()
+
+    start = time.time()
+    proposals = seed(db, args.users, args.proposals, args.comments)
+    indexed = index_payments()
+    print(f'seeded {args.users} users, {len(proposals)} proposals, {args.comments} comments each, '
+          f'{indexed} payments from the stub wallet-rpc in {time.time() - start:.1f}s')
+
+    pids = [p.id for p in proposals]
+    addresses = [p.addr_donation for p in proposals[:20]]
+    routes = [
+        ('/proposals', ['/proposals', '/proposals?status=2', '/proposals?status=3&cat=core']),
+        ('/proposal/<pid>', ['/proposal/%d' % pid for pid in pids]),
+        ('/search', ['/search?key=%s' % word for word in WORDS]),
+        ('/api/1/proposals', ['/api/1/proposals?status=%d' % status for status in (1, 2, 3, 4)]),
+        ('/api/1/qr', ['/api/1/qr?address=%s' % address for address in addresses]),
+    ]
+
+    counter = QueryCounter(db.engine)
+    client = app.test_client()
+    failed = 0
+
+    print(f'{"route":<20}{"p50":>9}{"p90":>9}{"p99":>9}{"max":>9}{"queries":>9}{"max q":>7}{"fail":>6}')
+    for name, urls in routes:
+        latencies, queries, failures = bench_route(client, cache, counter, urls, args.requests, args.cold)
+        failed += failures
+        print(f'{name:<20}'
+              f'{percentile(latencies, 50):>7.1f}ms{percentile(latencies, 90):>7.1f}ms'
+              f'{percentile(latencies, 99):>7.1f}ms{max(latencies):>7.1f}ms'
+              f'{sum(queries) / len(queries):>9.1f}{max(queries):>7}{failures:>6}')
+
+    server.shutdown()
+    return 0 if not failed else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,10 +1,10 @@
 import re
 
 import requests
-from flask import jsonify, send_from_directory, Response
+from flask import request, jsonify, Response
 from flask_yoloapi import endpoint, parameter
 
-from funding.bin.utils import get_ip
+from funding.bin.utils import Summary, get_ip, make_etag, not_modified, set_validators
 from funding.bin.qr import QrCodeGenerator
 from funding.factory import app, cache
 from funding.orm import Proposal
@@ -18,12 +18,34 @@ from funding.orm import Proposal
     parameter('offset', type=int, location='args', default=0)
 )
 def api_proposals_get(status, cat, limit, offset):
+    changes = Summary.fetch_last_changes()
+    etag = make_etag('api_proposals', status, cat, limit, offset, changes['etag'])
+    resp = not_modified(etag, changes['last_modified'])
+    if resp:
+        return resp
+
     try:
         proposals = Proposal.find_by_args(status=status, cat=cat, limit=limit, offset=offset)
     except Exception as ex:
         print(ex)
         return 'error', 500
-    return [p.json for p in proposals]
+    return set_validators(jsonify(data=[p.json for p in proposals]), etag, changes['last_modified'])
+
+
+@app.route('/api/1/search')
+@endpoint.api(
+    parameter('key', type=str, location='args', required=True),
+    parameter('limit', type=int, location='args', default=20),
+    parameter('offset', type=int, location='args', default=0)
+)
+def api_proposals_search(key, limit, offset):
+    limit = min(max(limit, 1), 50)
+    try:
+        proposals = Proposal.search(key=key, limit=limit, offset=max(offset, 0))
+    except Exception as ex:
+        print(ex)
+        return 'error', 500
+    return [dict(p.json, snippet=str(p.snippet)) for p in proposals]
 
 
 @app.route('/api/1/convert/wow-usd')
@@ -33,7 +55,10 @@ def api_proposals_get(status, cat, limit, offset):
 def api_coin_usd(amount):
     from funding.bin.utils import Summary, coin_to_usd
     prices = Summary.fetch_prices()
-    return jsonify(usd=coin_to_usd(amt=amount, btc_per_coin=prices['coin-btc'], usd_per_btc=prices['btc-usd']))
+    if not prices:
+        return Response('Prices not available yet, try again later', 503)
+    return jsonify(usd=coin_to_usd(amt=amount, btc_per_coin=prices['coin-btc'], usd_per_btc=prices['btc-usd']),
+                   age=prices['age'])
 
 
 @app.route('/api/1/qr')
@@ -49,23 +74,33 @@ def api_qr_generate(address):
     from funding.factory import cache
 
     qr = QrCodeGenerator()
-    if not qr.exists(address):
-        # create a new QR code
-        ip = get_ip()
-        cache_key = 'qr_ip_%s' % ip
-        hit = cache.get(cache_key)
-
-        if hit and ip not in ['127.0.0.1', 'localhost']:
-            return Response('Wait a bit before generating a new QR', 403)
-
-        throttling_seconds = 3
-        cache.set(cache_key, {'wow': 'kek'}, throttling_seconds)
-
-        created = qr.create(address)
-        if not created:
-            raise Exception('Could not create QR code')
-
-    return send_from_directory('static/qr', '%s.png' % address)
+    key = qr.key(address)
+    if request.if_none_match.contains(key):
+        resp = Response(status=304)
+    else:
+        image = qr.get(address)
+        if image is None:
+            # create a new QR code
+            ip = get_ip()
+            cache_key = 'qr_ip_%s' % ip
+            hit = cache.get(cache_key)
+
+            if hit and ip not in ['127.0.0.1', 'localhost']:
+                return Response('Wait a bit before generating a new QR', 403)
+
+            throttling_seconds = 3
+            cache.set(cache_key, {'wow': 'kek'}, throttling_seconds)
+
+            image = qr.create(address)
+            if not image:
+                raise Exception('Could not create QR code')
+
+        resp = Response(image, mimetype='image/png')
+
+    # images never change for a given key
+    resp.set_etag(key)
+    resp.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return resp
 
 
 @app.route('/api/1/wowlite')
@@ -0,0 +1,29 @@
+import settings
+from funding.bin.daemon import Daemon
+from funding.factory import db
+
+
+def top_up(daemon: Daemon = None):
+    """
+    Mint integrated addresses until the pool holds
+    ADDRESS_POOL_WATERMARK unclaimed ones.
+    :return: amount of addresses created
+    """
+    from funding.orm import IntegratedAddress
+
+    daemon = daemon or Daemon()
+    missing = settings.ADDRESS_POOL_WATERMARK - IntegratedAddress.available()
+
+    created = 0
+    for _ in range(max(0, missing)):
+        blob = daemon.make_integrated_address()
+        try:
+            db.session.add(IntegratedAddress(address=blob['integrated_address'],
+                                             payment_id=blob['payment_id']))
+            db.session.commit()
+            db.session.flush()
+        except:
+            db.session.rollback()
+            raise
+        created += 1
+    return created
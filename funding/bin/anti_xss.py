@@ -24,45 +24,60 @@ Cannot defense xss in browser which is belowed IE7
 浏览器版本：IE7+ 或其他浏览器，无法防御IE6及以下版本浏览器中的XSS
 """
 import re
-try:
-    from html.parser import HTMLParser
-except:
-    from HTMLParser import HTMLParser
+from html import unescape
+from html.parser import HTMLParser
+
 
 class XssHtml(HTMLParser):
-    allow_tags = ['a', 'img', 'br', 'strong', 'b', 'code', 'pre',
-                  'p', 'div', 'em', 'span', 'h1', 'h2', 'h3', 'h4',
-                  'h5', 'h6', 'blockquote', 'ul', 'ol', 'tr', 'th', 'td',
-                  'hr', 'li', 'u', 'embed', 's', 'table', 'thead', 'tbody',
-                  'caption', 'small', 'q', 'sup', 'sub']
-    common_attrs = ["style", "class", "name"]
-    nonend_tags = ["img", "hr", "br", "embed"]
+    allow_tags = frozenset([
+        'a', 'img', 'br', 'strong', 'b', 'code', 'pre',
+        'p', 'div', 'em', 'span', 'h1', 'h2', 'h3', 'h4',
+        'h5', 'h6', 'blockquote', 'ul', 'ol', 'tr', 'th', 'td',
+        'hr', 'li', 'u', 'embed', 's', 'table', 'thead', 'tbody',
+        'caption', 'small', 'q', 'sup', 'sub'])
+    common_attrs = frozenset(["style", "class", "name"])
+    nonend_tags = frozenset(["img", "hr", "br", "embed"])
     tags_own_attrs = {
         "img": ["src", "width", "height", "alt", "align"],
         "a": ["href", "target", "rel", "title"],
         "embed": ["src", "width", "height", "type", "allowfullscreen", "loop", "play", "wmode", "menu"],
         "table": ["border", "cellpadding", "cellspacing"],
     }
+    tags_attrs = {}  # tags_own_attrs plus common_attrs, see below
+
+    limit_a = {
+        "target": frozenset(["_blank", "_self"])
+    }
+    limit_embed = {
+        "type": frozenset(["application/x-shockwave-flash"]),
+        "wmode": frozenset(["transparent", "window", "opaque"]),
+        "play": frozenset(["true", "false"]),
+        "loop": frozenset(["true", "false"]),
+        "menu": frozenset(["true", "false"]),
+        "allowfullscreen": frozenset(["true", "false"])
+    }
 
     _regex_url = re.compile(r'^(http|https|ftp)://.*', re.I | re.S)
     _regex_style_1 = re.compile(r'(\\|&#|/\*|\*/)', re.I)
     _regex_style_2 = re.compile(r'e.*x.*p.*r.*e.*s.*s.*i.*o.*n', re.I | re.S)
 
-
-    def __init__(self, allows=[]):
+    def __init__(self, allows=None):
         HTMLParser.__init__(self)
-        self.allow_tags = allows if allows else self.allow_tags
+        if allows:
+            self.allow_tags = frozenset(allows)
         self.result = []
         self.start = []
-        self.data = []
 
     def getHtml(self):
         """
         Get the safe html code
         """
-        for i in range(0, len(self.result)):
-            self.data.append(self.result[i])
-        return ''.join(self.data)
+        return ''.join(self.result)
+
+    def updatepos(self, i, j):
+        # line/offset bookkeeping is only used for getpos(), which
+        # nothing reads; skipping it saves a count() per token
+        return j
 
     def handle_startendtag(self, tag, attrs):
         self.handle_starttag(tag, attrs)
@@ -70,27 +85,33 @@ class XssHtml(HTMLParser):
     def handle_starttag(self, tag, attrs):
         if tag not in self.allow_tags:
             return
-        end_diagonal = ' /' if tag in self.nonend_tags else ''
-        if not end_diagonal:
+        nonend = tag in self.nonend_tags
+        if not nonend:
             self.start.append(tag)
-        attdict = {}
-        for attr in attrs:
-            attdict[attr[0]] = attr[1]
-
-        attdict = self._wash_attr(attdict, tag)
-        if hasattr(self, "node_%s" % tag):
-            attdict = getattr(self, "node_%s" % tag)(attdict)
-        else:
-            attdict = self.node_default(attdict)
 
-        attrs = []
-        for (key, value) in attdict.items():
-            attrs.append('%s="%s"' % (key, self._htmlspecialchars(value)))
-        attrs = (' ' + ' '.join(attrs)) if attrs else ''
-        self.result.append('<' + tag + attrs + end_diagonal + '>')
+        # filter while collecting; a repeated attribute keeps its first
+        # position and its last value
+        allowed = self.tags_attrs.get(tag, self.common_attrs)
+        attdict = {}
+        for key, value in attrs:
+            if key in allowed:
+                attdict[key] = value
+
+        if "style" in attdict:
+            attdict["style"] = self._true_style(attdict["style"])
+        if tag == "a":
+            self.node_a(attdict)
+        elif tag == "embed":
+            self.node_embed(attdict)
+
+        out = '<' + tag
+        escape = self._htmlspecialchars
+        for key, value in attdict.items():
+            out += ' %s="%s"' % (key, escape(value))
+        self.result.append(out + ' />' if nonend else out + '>')
 
     def handle_endtag(self, tag):
-        if self.start and tag == self.start[len(self.start) - 1]:
+        if self.start and tag == self.start[-1]:
             self.result.append('</' + tag + '>')
             self.start.pop()
 
@@ -105,33 +126,19 @@ class XssHtml(HTMLParser):
         if name.isdigit():
             self.result.append("&#%s;" % name)
 
-    def node_default(self, attrs):
-        attrs = self._common_attr(attrs)
-        return attrs
-
     def node_a(self, attrs):
-        attrs = self._common_attr(attrs)
-        attrs = self._get_link(attrs, "href")
-        attrs = self._set_attr_default(attrs, "target", "_blank")
-        attrs = self._limit_attr(attrs, {
-            "target": ["_blank", "_self"]
-        })
-        return attrs
+        if "href" in attrs:
+            attrs["href"] = self._true_url(attrs["href"])
+        if "target" not in attrs:
+            attrs["target"] = "_blank"
+        self._limit_attr(attrs, self.limit_a)
 
     def node_embed(self, attrs):
-        attrs = self._common_attr(attrs)
-        attrs = self._get_link(attrs, "src")
-        attrs = self._limit_attr(attrs, {
-            "type": ["application/x-shockwave-flash"],
-            "wmode": ["transparent", "window", "opaque"],
-            "play": ["true", "false"],
-            "loop": ["true", "false"],
-            "menu": ["true", "false"],
-            "allowfullscreen": ["true", "false"]
-        })
+        if "src" in attrs:
+            attrs["src"] = self._true_url(attrs["src"])
+        self._limit_attr(attrs, self.limit_embed)
         attrs["allowscriptaccess"] = "never"
         attrs["allownetworking"] = "none"
-        return attrs
 
     def _true_url(self, url):
         if self._regex_url.match(url):
@@ -145,66 +152,37 @@ class XssHtml(HTMLParser):
             style = self._regex_style_2.sub('_', style)
         return style
 
-    def _get_style(self, attrs):
-        if "style" in attrs:
-            attrs["style"] = self._true_style(attrs.get("style"))
-        return attrs
-
-    def _get_link(self, attrs, name):
-        if name in attrs:
-            attrs[name] = self._true_url(attrs[name])
-        return attrs
-
-    def _wash_attr(self, attrs, tag):
-        if tag in self.tags_own_attrs:
-            other = self.tags_own_attrs.get(tag)
-        else:
-            other = []
-
-        _attrs = {}
-        if attrs:
-            for (key, value) in attrs.items():
-                if key in self.common_attrs + other:
-                    _attrs[key] = value
-        return _attrs
-
-    def _common_attr(self, attrs):
-        attrs = self._get_style(attrs)
-        return attrs
-
-    def _set_attr_default(self, attrs, name, default=''):
-        if name not in attrs:
-            attrs[name] = default
-        return attrs
-
-    def _limit_attr(self, attrs, limit={}):
-        for (key, value) in limit.items():
-            if key in attrs and attrs[key] not in value:
+    @staticmethod
+    def _limit_attr(attrs, limit):
+        for key, values in limit.items():
+            if key in attrs and attrs[key] not in values:
                 del attrs[key]
-        return attrs
 
-    def _htmlspecialchars(self, html):
+    @staticmethod
+    def _htmlspecialchars(html):
         return html.replace("<", "&lt;")\
             .replace(">", "&gt;")\
             .replace('"', "&quot;")\
             .replace("'", "&#039;")
 
 
+# attributes allowed per tag, common ones included; computed once
+XssHtml.tags_attrs = {tag: XssHtml.common_attrs.union(own) for tag, own in XssHtml.tags_own_attrs.items()}
+
+
 def such_xss(inp):
     """Very ghetto anti-xss countermeasures. Possibly unsafe! :D
     Needs testing, or a proper solution. wow."""
-    parser = XssHtml()
-    parser.feed(inp)
-    parser.close()
-    result = parser.getHtml()
+    if '<' not in inp:
+        # no markup: the parser would only unescape and escape the text
+        result = XssHtml._htmlspecialchars(unescape(inp))
+    else:
+        parser = XssHtml()
+        parser.feed(inp)
+        parser.close()
+        result = parser.getHtml()
 
     # oh noes teh markdown blockquotes
-    lines = result.split('\n')
-    _lines = []
-    for line in lines:
-        if line.startswith('&gt;'):
-            line = line[4:]
-            line = '>%s' % line
-        _lines.append(line)
-
-    return "\n".join(_lines)
\ No newline at end of file
+    if result.startswith('&gt;'):
+        result = '>' + result[4:]
+    return result.replace('\n&gt;', '\n>')
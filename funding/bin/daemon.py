@@ -0,0 +1,67 @@
+import time
+
+import requests
+from requests.auth import HTTPDigestAuth
+
+import settings
+from funding.bin.metrics import observe_rpc
+
+
+class Daemon:
+    def __init__(self, url=None, username=None, password=None, timeout=None):
+        self.url = url or settings.RPC_LOCATION
+        self.username = username if username is not None else settings.RPC_USERNAME
+        self.password = password if password is not None else settings.RPC_PASSWORD
+        self.timeout = timeout or settings.RPC_TIMEOUT
+        self.headers = {"User-Agent": "WFS"}
+
+    def get_bulk_payments(self, payment_ids: list, min_block_height: int = 0):
+        """Incoming payments for a list of payment ids, above
+        `min_block_height`. Returns a list of payment dicts."""
+        if not payment_ids:
+            return []
+
+        result = self._make_request("get_bulk_payments", {
+            "payment_ids": payment_ids,
+            "min_block_height": min_block_height
+        })
+        return result.get("payments", [])
+
+    def get_transfer_by_txid(self, txid: str):
+        """All transfers for a single txid. Returns a list of
+        transfer dicts (one per subaddress involved)."""
+        result = self._make_request("get_transfer_by_txid", {"txid": txid})
+        if "transfers" in result:
+            return result["transfers"]
+        return [result["transfer"]]
+
+    def make_integrated_address(self):
+        result = self._make_request("make_integrated_address")
+        assert 'integrated_address' in result
+        assert 'payment_id' in result
+        return result
+
+    def _make_request(self, method: str, params: dict = None):
+        data = {
+            "jsonrpc": "2.0",
+            "id": "0",
+            "method": method
+        }
+        if params:
+            data["params"] = params
+
+        auth = HTTPDigestAuth(self.username, self.password) if self.username else None
+        start = time.perf_counter()
+        ok = False
+        try:
+            r = requests.post(self.url, json=data, auth=auth, headers=self.headers, timeout=self.timeout)
+            r.raise_for_status()
+            blob = r.json()
+
+            if 'error' in blob:
+                raise Exception(f"wallet-rpc error for {method}: {blob['error'].get('message')}")
+            assert 'result' in blob
+            ok = True
+            return blob['result']
+        finally:
+            observe_rpc(method, time.perf_counter() - start, ok)
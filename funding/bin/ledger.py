@@ -0,0 +1,159 @@
+from sqlalchemy.dialects.postgresql import insert
+
+import settings
+from funding.bin.daemon import Daemon
+from funding.factory import db, cache
+
+
+def index_payments(daemon: Daemon = None):
+    """
+    Fetch new incoming payments for all active proposals with a single
+    `get_bulk_payments` call, starting from the stored cursor, and write
+    them to the transactions ledger.
+    :return: amount of payments received from wallet-rpc
+    """
+    from funding.orm import Proposal, LedgerCursor
+
+    daemon = daemon or Daemon()
+    cursor = LedgerCursor.get('payments')
+
+    q = db.session.query(Proposal.id, Proposal.payment_id)
+    q = q.filter(Proposal.archived.isnot(True))
+    q = q.filter(Proposal.payment_id.isnot(None))
+    payment_ids = {payment_id: pid for pid, payment_id in q.all()}
+
+    min_block_height = max(0, cursor.height - settings.LEDGER_RESCAN_DEPTH)
+    payments = daemon.get_bulk_payments(list(payment_ids), min_block_height=min_block_height)
+
+    proposal_ids = ingest_payments(payments, payment_ids)
+
+    heights = [int(p['block_height']) for p in payments]
+    if heights:
+        cursor.height = max(cursor.height, *heights)
+
+    try:
+        db.session.commit()
+        db.session.flush()
+    except:
+        db.session.rollback()
+        raise
+    if proposal_ids:
+        cache.delete('ledger_version')
+
+    update_funds_progress(proposal_ids)
+    return len(payments)
+
+
+def ingest_txid(txid: str, daemon: Daemon = None):
+    """
+    Fetch a single transfer (as announced by wallet-rpc's `--tx-notify`)
+    and write it to the ledger. Pool transfers are stored with a block
+    height of 0 and updated once they are mined.
+    :return: set of proposal ids that were touched
+    """
+    from funding.orm import Proposal
+
+    daemon = daemon or Daemon()
+    transfers = daemon.get_transfer_by_txid(txid)
+
+    payments = []
+    for transfer in transfers:
+        if transfer.get('type') not in ['in', 'pool']:
+            continue
+        payments.append({
+            'payment_id': transfer.get('payment_id'),
+            'tx_hash': transfer['txid'],
+            'amount': transfer['amount'],
+            'block_height': transfer.get('height', 0)
+        })
+
+    q = db.session.query(Proposal.id, Proposal.payment_id)
+    q = q.filter(Proposal.payment_id.in_([p['payment_id'] for p in payments]))
+    payment_ids = {payment_id: pid for pid, payment_id in q.all()}
+
+    proposal_ids = ingest_payments(payments, payment_ids)
+    try:
+        db.session.commit()
+        db.session.flush()
+    except:
+        db.session.rollback()
+        raise
+    if proposal_ids:
+        cache.delete('ledger_version')
+
+    update_funds_progress(proposal_ids)
+    return proposal_ids
+
+
+def ingest_payments(payments: list, payment_ids: dict):
+    """
+    Upsert wallet-rpc payment entries into the transactions ledger.
+    Does not commit.
+    :param payments: payment dicts as returned by wallet-rpc
+    :param payment_ids: mapping of payment_id to proposal id
+    :return: set of proposal ids that were touched
+    """
+    from funding.orm import Transaction
+
+    touched = set()
+    for payment in payments:
+        pid = payment_ids.get(payment['payment_id'])
+        if not pid:
+            continue
+
+        stmt = insert(Transaction.__table__).values(
+            proposal_id=pid,
+            txid=payment['tx_hash'],
+            payment_id=payment['payment_id'],
+            amount=int(payment['amount']),
+            block_height=int(payment.get('block_height') or 0))
+        stmt = stmt.on_conflict_do_update(
+            constraint='uq_transaction_txid_payment_id',
+            set_={'amount': stmt.excluded.amount,
+                  'block_height': stmt.excluded.block_height})
+        db.session.execute(stmt)
+        touched.add(pid)
+
+    return touched
+
+
+def update_funds_progress(proposal_ids: set = None):
+    """
+    Recompute `Proposal.funds_progress` from confirmed ledger entries in
+    one UPDATE, for the given proposals or, with None, for all of them.
+    Only rows whose progress changed are written. Drops the cached
+    balance of the given proposals and of every changed one, and bumps
+    `ledger_version` when anything changed.
+    :return: ids of the proposals whose progress changed
+    """
+    from funding.orm import Proposal, Transaction
+
+    if proposal_ids is not None and not proposal_ids:
+        return set()
+
+    p = Proposal.__table__
+    t = Transaction.__table__
+    raised = db.select([db.func.coalesce(db.func.sum(t.c.amount), 0)])
+    raised = raised.where(t.c.proposal_id == p.c.id)
+    raised = raised.where(t.c.block_height > 0)
+    raised = raised.as_scalar()
+    progress = db.func.coalesce(raised / 1e11 * 100 / db.func.nullif(p.c.funds_target, 0), 0)
+
+    stmt = p.update().values(funds_progress=progress)
+    stmt = stmt.where(p.c.funds_progress != progress)
+    if proposal_ids is not None:
+        stmt = stmt.where(p.c.id.in_(proposal_ids))
+    try:
+        changed = {row[0] for row in db.session.execute(stmt.returning(p.c.id))}
+        db.session.commit()
+        db.session.flush()
+    except:
+        db.session.rollback()
+        raise
+
+    for pid in changed.union(proposal_ids or ()):
+        cache.delete(f"proposal_balance_{pid}")
+        cache.delete(Proposal.version_key(pid))
+    if changed:
+        cache.delete('ledger_version')
+    return changed
@@ -0,0 +1,149 @@
+"""
+Prometheus metrics, served by /internal/metrics.
+
+Under gunicorn every worker is its own process; for the numbers to add
+up across workers, start gunicorn with PROMETHEUS_MULTIPROC_DIR pointing
+at an empty directory (wiped on every restart), and in its config file:
+
+    from funding.bin.metrics import child_exit
+"""
+import os
+import time
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, \
+    CONTENT_TYPE_LATEST, REGISTRY, generate_latest, multiprocess
+
+import settings
+
+REQUEST_LATENCY = Histogram(
+    'funding_request_duration_seconds', 'Request latency per endpoint',
+    ['endpoint', 'method'])
+REQUESTS = Counter(
+    'funding_requests_total', 'Requests per endpoint and status',
+    ['endpoint', 'method', 'status'])
+DB_POOL_CHECKED_OUT = Gauge(
+    'funding_db_pool_checked_out', 'Database connections in use',
+    multiprocess_mode='livesum')
+DB_POOL_SIZE = Gauge(
+    'funding_db_pool_size', 'Database connections the pools keep',
+    multiprocess_mode='livesum')
+RPC_LATENCY = Histogram(
+    'funding_wallet_rpc_duration_seconds', 'wallet-rpc call latency',
+    ['method'])
+RPC_REQUESTS = Counter(
+    'funding_wallet_rpc_requests_total', 'wallet-rpc calls',
+    ['method', 'result'])
+CACHE_REQUESTS = Counter(
+    'funding_cache_requests_total', 'Cache reads per key family',
+    ['family', 'result'])
+QR_RENDERS = Counter(
+    'funding_qr_renders_total', 'QR images rendered')
+
+# cache key prefix -> family label, first match wins. Keys can carry
+# user input (addresses, client IPs, versions), so only these labels
+# are ever exported; anything else is counted as 'other'.
+KEY_FAMILIES = (
+    ('_template_fragment_cache_', 'fragment'),
+    ('api_wowlight_version_check_', 'api_wowlight_version_check'),
+    ('content_version', 'content_version'),
+    ('funding_stats', 'funding_stats'),
+    ('ledger_version', 'ledger_version'),
+    ('lock_', 'lock'),
+    ('markdown_', 'markdown'),
+    ('microcache_', 'microcache'),
+    ('price_oracle', 'price_oracle'),
+    ('proposal_balance_', 'proposal_balance'),
+    ('proposal_version_', 'proposal_version'),
+    ('qr_ip_', 'qr_throttle'),
+    ('qr_', 'qr'),
+    ('sidebar_data', 'sidebar_data'),
+    ('wow_supply', 'wow_supply'),
+)
+
+
+# any token is a valid method; everything else is counted as 'other'
+METHODS = frozenset(('GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'))
+
+
+def method_label(method):
+    return method if method in METHODS else 'other'
+
+
+def key_family(key):
+    if isinstance(key, str):
+        for prefix, family in KEY_FAMILIES:
+            if key.startswith(prefix):
+                return family
+    return 'other'
+
+
+def observe_rpc(method, seconds, ok):
+    if settings.METRICS_ENABLED:
+        RPC_LATENCY.labels(method).observe(seconds)
+        RPC_REQUESTS.labels(method, 'ok' if ok else 'error').inc()
+
+
+def observe_qr_render():
+    if settings.METRICS_ENABLED:
+        QR_RENDERS.inc()
+
+
+def _cache_get(get):
+    def wrapper(key):
+        value = get(key)
+        CACHE_REQUESTS.labels(key_family(key), 'miss' if value is None else 'hit').inc()
+        return value
+    return wrapper
+
+
+def _checkout(dbapi_connection, connection_record, connection_proxy):
+    DB_POOL_CHECKED_OUT.inc()
+
+
+def _checkin(dbapi_connection, connection_record):
+    DB_POOL_CHECKED_OUT.dec()
+
+
+def install(cache, db):
+    """Count cache hits/misses and track the database pool.
+    Only done when METRICS_ENABLED is set."""
+    import sqlalchemy as sa
+
+    backend = cache.cache
+    backend.get = _cache_get(backend.get)
+
+    sa.event.listen(sa.pool.Pool, 'checkout', _checkout)
+    sa.event.listen(sa.pool.Pool, 'checkin', _checkin)
+    if hasattr(db.engine.pool, 'size'):
+        DB_POOL_SIZE.set(db.engine.pool.size())
+
+
+def start():
+    from flask import g
+    g.metrics_start = time.perf_counter()
+
+
+def finish(res):
+    from flask import g, request
+    start = g.pop('metrics_start', None)
+    if start is not None:
+        endpoint = request.endpoint or 'none'
+        method = method_label(request.method)
+        REQUEST_LATENCY.labels(endpoint, method).observe(time.perf_counter() - start)
+        REQUESTS.labels(endpoint, method, res.status_code).inc()
+    return res
+
+
+def generate():
+    """:return: (exposition text, content type)"""
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def child_exit(server, worker):
+    """gunicorn hook: drop the live gauges of a worker that exited"""
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,105 @@
+import hashlib
+import time
+import uuid
+
+from flask import request, session, Response
+
+import settings
+from funding.bin.single_flight import release
+from funding.factory import app, cache
+
+# per-request state lives in the WSGI environ: `g` belongs to the app
+# context, which create_app() keeps pushed across requests
+ENV_KEY = 'funding.microcache_key'
+ENV_LOCK = 'funding.microcache_lock'
+
+
+def _ttl():
+    return min(max(int(settings.MICROCACHE_TTL), 1), 10)
+
+
+def _eligible():
+    if not settings.MICROCACHE_TTL or request.method != 'GET':
+        return False
+    if request.endpoint not in settings.MICROCACHE_ENDPOINTS:
+        return False
+    # logged in (or about to be), or has flashed messages waiting
+    cookies = [app.config['SESSION_COOKIE_NAME'], 'remember_token']
+    return not any(name in request.cookies for name in cookies)
+
+
+def _response(hit):
+    body, status, headers = hit
+    resp = Response(body, status=status, headers=headers)
+    resp.headers['X-Microcache'] = 'HIT'
+    return resp.make_conditional(request)
+
+
+def lookup():
+    """
+    Full-page cache for anonymous GETs, opt-in through MICROCACHE_TTL.
+    Returns a cached response, or None when the page should be rendered.
+    Only one worker renders a given page at a time (single-flight through
+    a Redis lock), the others wait for its result. The lock holder
+    renders the full page regardless of the client's validators, so
+    there is always a page to store; `store` answers it conditionally.
+    """
+    if not _eligible():
+        return
+
+    key = 'microcache_%s' % hashlib.sha1(request.full_path.encode()).hexdigest()
+    request.environ[ENV_KEY] = key
+
+    hit = cache.get(key)
+    if hit:
+        return _response(hit)
+
+    token = uuid.uuid4().hex
+    if cache.add(key + '_lock', token, timeout=settings.MICROCACHE_LOCK_TIMEOUT):
+        request.environ[ENV_LOCK] = token
+        return
+
+    deadline = time.time() + settings.MICROCACHE_LOCK_TIMEOUT
+    while time.time() < deadline:
+        time.sleep(0.05)
+        hit = cache.get(key)
+        if hit:
+            return _response(hit)
+        if not cache.get(key + '_lock'):
+            # released without storing (not cacheable, or it failed)
+            return
+    # the rendering worker is too slow or died, render ourselves
+
+
+def _over_budget():
+    # checked here, as the query tracker's own check runs after `store`
+    if not settings.QUERY_TRACKER:
+        return False
+    from funding.bin.query_tracker import over_budget
+    return bool(over_budget())
+
+
+def rendering():
+    """Whether this request renders a page for the microcache"""
+    return ENV_LOCK in request.environ
+
+
+def store(resp):
+    """Cache the freshly rendered page, release the render lock"""
+    key = request.environ.get(ENV_KEY)
+    if not key:
+        return resp
+
+    token = request.environ.get(ENV_LOCK)
+    try:
+        if resp.status_code == 200 and not resp.direct_passthrough and not session.modified \
+                and 'Set-Cookie' not in resp.headers and 'X-Microcache' not in resp.headers \
+                and not _over_budget():
+            headers = [(k, v) for k, v in resp.headers.items() if k != 'Content-Length']
+            cache.set(key, (resp.get_data(), resp.status_code, headers), timeout=_ttl())
+    finally:
+        if token:
+            release(key + '_lock', token)
+    if token and resp.status_code == 200 and not resp.direct_passthrough:
+        return resp.make_conditional(request)
+    return resp
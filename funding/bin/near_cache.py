@@ -0,0 +1,181 @@
+import os
+import pickle
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import redis
+
+import settings
+
+
+class TTLLRU:
+    """Bounded thread-safe in-process LRU whose entries expire"""
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None:
+                return
+            expires, value = entry
+            if expires < time.monotonic():
+                del self.data[key]
+                return
+            self.data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = (time.monotonic() + self.ttl, value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def pop(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+class NearCache:
+    """
+    Per-worker cache in front of the flask-caching Redis backend, for a
+    few hot keys (`keys` are prefixes). Reads of those keys are answered
+    from memory for up to `ttl` seconds; writes and deletes go to Redis
+    and are announced over pub/sub, so every worker drops its copy.
+    While the subscription is down, reads go straight to Redis.
+
+    Values are kept pickled, so callers never share (and mutate) the
+    same object, just like values coming from Redis.
+    """
+    def __init__(self, keys, maxsize, ttl, channel='near_cache'):
+        self.keys = tuple(keys)
+        self.lru = TTLLRU(maxsize, ttl)
+        self.channel = channel
+        self.sender = uuid.uuid4().hex
+        self.backend = None
+        self.client = None
+        self.pid = None
+        self.subscribed = threading.Event()
+        self.start_lock = threading.Lock()
+        # bumped by every invalidation, local or received; a value read
+        # from Redis is only kept when none happened while it was read
+        self.generation = 0
+
+    def install(self, cache):
+        """Wrap the backend methods of a flask-caching `Cache`"""
+        self.backend = backend = cache.cache
+        self._get, self._set, self._add = backend.get, backend.set, backend.add
+        self._delete, self._delete_many, self._clear = backend.delete, backend.delete_many, backend.clear
+        backend.get, backend.set, backend.add = self.get, self.set, self.add
+        backend.delete, backend.delete_many, backend.clear = self.delete, self.delete_many, self.clear
+
+    def hot(self, key):
+        return isinstance(key, str) and key.startswith(self.keys)
+
+    def get(self, key):
+        if not self.hot(key) or not self._listening():
+            return self._get(key)
+
+        blob = self.lru.get(key)
+        if blob is not None:
+            return pickle.loads(blob)
+
+        generation = self.generation
+        value = self._get(key)
+        if value is not None and generation == self.generation:
+            self.lru.put(key, pickle.dumps(value))
+        return value
+
+    def set(self, key, value, timeout=None):
+        rtn = self._set(key, value, timeout=timeout)
+        self._invalidate(key)
+        return rtn
+
+    def add(self, key, value, timeout=None):
+        rtn = self._add(key, value, timeout=timeout)
+        if rtn:
+            self._invalidate(key)
+        return rtn
+
+    def delete(self, key):
+        rtn = self._delete(key)
+        self._invalidate(key)
+        return rtn
+
+    def delete_many(self, *keys):
+        rtn = self._delete_many(*keys)
+        for key in keys:
+            self._invalidate(key)
+        return rtn
+
+    def clear(self):
+        rtn = self._clear()
+        self.generation += 1
+        self.lru.clear()
+        self._publish('*')
+        return rtn
+
+    def _invalidate(self, key):
+        if self.hot(key):
+            self.generation += 1
+            self.lru.pop(key)
+            self._publish(key)
+
+    def _publish(self, key):
+        try:
+            self._redis().publish(self.channel, f'{self.sender}:{key}')
+        except redis.RedisError:
+            # the others still drop it after `ttl`
+            pass
+
+    def _redis(self):
+        if self.client is None:
+            self.client = redis.from_url(settings.REDIS_URI)
+        return self.client
+
+    def _listening(self):
+        # (re)start the subscriber in every process, e.g. after a fork
+        if self.pid != os.getpid():
+            with self.start_lock:
+                if self.pid != os.getpid():
+                    self.sender = uuid.uuid4().hex
+                    self.client = None
+                    self.lru.clear()
+                    self.subscribed.clear()
+                    self.pid = os.getpid()
+                    threading.Thread(target=self._listen, daemon=True).start()
+        return self.subscribed.is_set()
+
+    def _listen(self):
+        pid = self.pid
+        while pid == os.getpid():
+            try:
+                pubsub = redis.from_url(settings.REDIS_URI).pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                self.subscribed.set()
+                for message in pubsub.listen():
+                    sender, _, key = message['data'].decode().partition(':')
+                    if sender == self.sender:
+                        continue
+                    self.generation += 1
+                    if key == '*':
+                        self.lru.clear()
+                    else:
+                        self.lru.pop(key)
+            except redis.RedisError:
+                pass
+            # invalidations may have been missed
+            self.subscribed.clear()
+            self.generation += 1
+            self.lru.clear()
+            time.sleep(1)
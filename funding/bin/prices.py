@@ -0,0 +1,78 @@
+import threading
+import time
+
+import settings
+from funding.factory import app, cache
+
+
+class PriceOracle:
+    """
+    Keeps the last known good price of every feed in Redis, without
+    expiry. Readers get whatever is stored; once it is older than
+    PRICE_REFRESH_INTERVAL, a single worker (guarded by a Redis lock)
+    refreshes it in a background thread. A failing feed never
+    overwrites a good value, and is retried after PRICE_RETRY_INTERVAL.
+    """
+    cache_key = 'price_oracle'
+    lock_key = 'price_oracle_lock'
+
+    @classmethod
+    def get(cls):
+        blob = cache.get(cls.cache_key) or {}
+        now = time.time()
+
+        if any(key not in blob or now - blob[key]['updated'] > settings.PRICE_REFRESH_INTERVAL
+               for key in cls.feeds()):
+            cls.refresh_async()
+
+        if any(key not in blob for key in cls.feeds()):
+            return
+
+        prices = {key: blob[key]['value'] for key in cls.feeds()}
+        prices['age'] = int(now - min(blob[key]['updated'] for key in cls.feeds()))
+        return prices
+
+    @staticmethod
+    def feeds():
+        from funding.bin.utils import coin_btc_value, price_cmc_btc_usd
+        return {
+            'coin-btc': coin_btc_value,
+            'btc-usd': price_cmc_btc_usd
+        }
+
+    @classmethod
+    def refresh_async(cls):
+        # both feeds time out after PRICE_FEED_TIMEOUT, the lock
+        # outlives a refresh even when they are fetched in sequence
+        if not cache.add(cls.lock_key, True, timeout=settings.PRICE_FEED_TIMEOUT * 3):
+            return
+
+        def run():
+            with app.app_context():
+                start = time.time()
+                ok = False
+                try:
+                    blob = cls.refresh()
+                    ok = all(key in blob and blob[key]['updated'] >= start for key in cls.feeds())
+                finally:
+                    if ok:
+                        cache.delete(cls.lock_key)
+                    else:
+                        # a feed is down; keep the lock so requests don't retry it
+                        # until PRICE_RETRY_INTERVAL has passed
+                        cache.set(cls.lock_key, True, timeout=settings.PRICE_RETRY_INTERVAL)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    @classmethod
+    def refresh(cls):
+        """Fetch all feeds and store the ones that succeeded"""
+        blob = cache.get(cls.cache_key) or {}
+        now = time.time()
+        for key, feed in cls.feeds().items():
+            value = feed()
+            if value:
+                blob[key] = {'value': value, 'updated': now}
+
+        cache.set(cls.cache_key, blob, timeout=0)
+        return blob
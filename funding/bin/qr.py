@@ -1,44 +1,163 @@
+import hashlib
 import os
+import threading
+from collections import OrderedDict
+from functools import lru_cache
 from io import BytesIO
 
+import numpy as np
 import pyqrcode
-from PIL import Image, ImageDraw
+from PIL import Image
 
 import settings
+from funding.bin.metrics import observe_qr_render
+
+
+class FilesystemQrStore:
+    """PNGs in a local directory; only for single node setups"""
+    def __init__(self, base='funding/static/qr'):
+        self.base = base
+        if not os.path.exists(self.base):
+            os.mkdir(self.base)
+
+    def get(self, key):
+        try:
+            with open(os.path.join(self.base, '%s.png' % key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return
+
+    def put(self, key, image):
+        path = os.path.join(self.base, '%s.png' % key)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(image)
+        os.replace(path + '.tmp', path)
+
+    def exists(self, key):
+        return os.path.exists(os.path.join(self.base, '%s.png' % key))
+
+
+class RedisQrStore:
+    """PNGs in Redis, without expiry"""
+    def get(self, key):
+        from funding.factory import cache
+        return cache.get('qr_%s' % key)
+
+    def put(self, key, image):
+        from funding.factory import cache
+        cache.set('qr_%s' % key, image, timeout=0)
+
+    def exists(self, key):
+        from funding.factory import cache
+        return cache.has('qr_%s' % key)
+
+
+class PostgresQrStore:
+    """PNGs in the `qr_images` table"""
+    def get(self, key):
+        from funding.orm import QrImage
+        return QrImage.get(key)
+
+    def put(self, key, image):
+        from funding.orm import QrImage
+        QrImage.add(key, image)
+
+    def exists(self, key):
+        from funding.orm import QrImage
+        return QrImage.exists(key)
+
+
+class NullQrStore:
+    """Stores nothing; for rendering only"""
+    def get(self, key):
+        return
+
+    def put(self, key, image):
+        pass
+
+    def exists(self, key):
+        return False
+
+
+QR_STORES = {
+    'filesystem': FilesystemQrStore,
+    'redis': RedisQrStore,
+    'postgres': PostgresQrStore
+}
+
+
+class LRU:
+    """Small thread-safe in-process LRU"""
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.data:
+                return
+            self.data.move_to_end(key)
+            return self.data[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
 
 
 class QrCodeGenerator:
-    def __init__(self):
-        self.base = 'funding/static/qr'
+    lru = LRU(settings.QR_LRU_SIZE)
+
+    def __init__(self, store=None):
+        self.store = store or QR_STORES[settings.QR_STORE]()
         self.image_size = (300, 300)
         self.pil_save_options = {
             'quality': 25,
             'optimize': True
         }
 
-        if not os.path.exists(self.base):
-            os.mkdir(self.base)
+    def key(self, address, color_from=(210, 83, 200), color_to=(255, 169, 62)):
+        """Storage key and ETag of an image: address plus render parameters"""
+        blob = f'{address}:{self.image_size}:{color_from}:{color_to}'
+        return hashlib.sha256(blob.encode()).hexdigest()[:32]
 
     def exists(self, address):
-        if not os.path.exists(self.base):
-            os.mkdir(self.base)
-        if os.path.exists(os.path.join(self.base, '%s.png' % address)):
-            return True
+        key = self.key(address)
+        return self.lru.get(key) is not None or self.store.exists(key)
+
+    def get(self, address):
+        """The stored PNG for this address, or None"""
+        key = self.key(address)
+        image = self.lru.get(key)
+        if image is None:
+            image = self.store.get(key)
+            if image is not None:
+                self.lru.put(key, image)
+        return image
 
     def create(self, address, dest=None, color_from=(210, 83, 200), color_to=(255, 169, 62)):
         """
-        Create QR code image. Optionally a gradient.
+        Create QR code image, optionally a gradient, and put it in the store.
         :param address:
-        :param dest:
+        :param dest: optional path to write a copy to
         :param color_from: gradient from color
         :param color_to:  gradient to color
-        :return:
+        :return: PNG bytes
         """
+        image = self.render(address, color_from=color_from, color_to=color_to)
+        return self._store(self.key(address, color_from, color_to), image, dest)
+
+    def render(self, address, color_from=(210, 83, 200), color_to=(255, 169, 62)):
+        """Render the PNG without storing it
+        :return: PNG bytes"""
         if len(address) not in settings.COIN_ADDRESS_LENGTH:
             raise Exception(f'faulty address length, should be: {" or ".join(map(str, settings.COIN_ADDRESS_LENGTH))}')
 
-        if not dest:
-            dest = os.path.join(self.base, '%s.png' % address)
+        observe_qr_render()
+        output = BytesIO()
 
         created = pyqrcode.create(address, error='L')
         buffer = BytesIO()
@@ -48,39 +167,98 @@ class QrCodeGenerator:
         im = im.convert("RGBA")
         im.thumbnail(self.image_size)
 
-        im_data = im.getdata()
+        if not color_from and not color_to:
+            im.save(output, format='PNG', **self.pil_save_options)
+            return output.getvalue()
 
-        # make black color transparent
-        im_transparent = []
-        for color_point in im_data:
-            if sum(color_point[:3]) == 255 * 3:
-                im_transparent.append(color_point)
-            else:
-                # get rid of the subtle grey borders
-                alpha = 0 if color_from and color_to else 1
-                im_transparent.append((0, 0, 0, alpha))
-                continue
+        # turn QR into a gradient: keep the white pixels, everything
+        # else (including the subtle grey borders) becomes gradient
+        pixels = np.asarray(im)
+        white = (pixels[..., :3] == 255).all(axis=-1)
+        gradient = QrCodeGenerator.gradient(im.size, tuple(color_from), tuple(color_to))
 
-        if not color_from and not color_to:
-            im.save(dest, **self.pil_save_options)
-            return dest
+        im_gradient = Image.fromarray(np.where(white[..., None], pixels, gradient), 'RGBA')
+        im_gradient.save(output, format='PNG', **self.pil_save_options)
 
-        # turn QR into a gradient
-        im.putdata(im_transparent)
+        return output.getvalue()
 
-        gradient = Image.new('RGBA', im.size, color=0)
-        draw = ImageDraw.Draw(gradient)
+    def _store(self, key, image, dest=None):
+        self.store.put(key, image)
+        self.lru.put(key, image)
+        if dest:
+            with open(dest, 'wb') as f:
+                f.write(image)
+        return image
 
-        for i, color in enumerate(QrCodeGenerator.gradient_interpolate(color_from, color_to, im.width * 2)):
-            draw.line([(i, 0), (0, i)], tuple(color), width=1)
+    @staticmethod
+    def create_async(address):
+        """Render and store a QR code in a background thread,
+        so the first visitor does not pay for it"""
+        from funding.factory import app
 
-        im_gradient = Image.alpha_composite(gradient, im)
-        im_gradient.save(dest, **self.pil_save_options)
+        def run():
+            with app.app_context():
+                try:
+                    qr = QrCodeGenerator()
+                    if not qr.exists(address):
+                        qr.create(address)
+                except Exception as ex:
+                    app.logger.warning(f'could not pre-generate QR for {address}: {ex}')
 
-        return dest
+        threading.Thread(target=run, daemon=True).start()
+
+    @staticmethod
+    @lru_cache(maxsize=16)
+    def gradient(size, color_from, color_to):
+        """
+        Diagonal RGBA gradient, `color_from` in the top left corner. Pixel
+        (x, y) gets step x + y of `gradient_interpolate` over `width * 2`
+        steps. Computed once per size and color pair; read-only.
+        """
+        width, height = size
+        interval = width * 2
+        steps = np.arange(interval)[:, None]
+        det_co = np.array([(t - f) / interval for f, t in zip(color_from, color_to)])
+        colors = np.rint(np.array(color_from) + det_co * steps).astype(np.uint8)
+        colors = np.hstack([colors, np.full((interval, 1), 255, dtype=np.uint8)])
+
+        diagonal = np.arange(width)[None, :] + np.arange(height)[:, None]
+        gradient = colors[diagonal]
+        gradient.flags.writeable = False
+        return gradient
 
     @staticmethod
     def gradient_interpolate(color_from, color_to, interval):
         det_co = [(t - f) / interval for f, t in zip(color_from, color_to)]
         for i in range(interval):
             yield [round(f + det * i) for f, det in zip(color_from, det_co)]
+
+
+def _render(address):
+    # runs in a worker process; the parent stores the result, so
+    # no database or Redis connections are shared across the fork
+    return address, QrCodeGenerator(store=NullQrStore()).render(address)
+
+
+def pregenerate(addresses, processes=None):
+    """
+    Render QR codes for all addresses that are not stored yet,
+    across a process pool.
+    :return: (rendered, skipped, seconds)
+    """
+    import multiprocessing
+    import time
+
+    qr = QrCodeGenerator()
+    addresses = {a for a in addresses if a and len(a) in settings.COIN_ADDRESS_LENGTH}
+    todo = sorted(a for a in addresses if not qr.exists(a))
+    skipped = len(addresses) - len(todo)
+
+    start = time.time()
+    rendered = 0
+    if todo:
+        with multiprocessing.Pool(processes) as pool:
+            for address, image in pool.imap_unordered(_render, todo, chunksize=4):
+                qr._store(qr.key(address), image)
+                rendered += 1
+    return rendered, skipped, time.time() - start
@@ -0,0 +1,97 @@
+import os
+import re
+import traceback
+from collections import Counter
+
+from flask import current_app, g, has_request_context, request
+
+import settings
+
+_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_regex_params = re.compile(r'%\(\w+\)s|\?')
+_regex_in = re.compile(r'\((?:\?, )+\?\)')
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+def statement_shape(statement):
+    """The statement with its parameters (and IN lists) collapsed,
+    so the same query for different rows has the same shape"""
+    shape = _regex_params.sub('?', statement)
+    return _regex_in.sub('(?)', ' '.join(shape.split()))
+
+
+def call_site():
+    """Innermost frame of our own code (templates included) that led to a query"""
+    for frame, lineno in traceback.walk_stack(None):
+        filename = frame.f_code.co_filename
+        if filename.startswith(_root) and filename != __file__:
+            return '%s:%d (%s)' % (os.path.relpath(filename, _root), lineno, frame.f_code.co_name)
+    return 'unknown'
+
+
+class RequestQueries:
+    """Statements issued during one request, by shape"""
+    def __init__(self):
+        self.count = 0
+        self.shapes = Counter()
+        self.sites = {}
+
+    def add(self, statement):
+        self.count += 1
+        shape = statement_shape(statement)
+        self.shapes[shape] += 1
+        if shape not in self.sites:
+            self.sites[shape] = call_site()
+
+    def repeated(self, threshold):
+        """(shape, count, call site) of shapes issued more than `threshold` times"""
+        return [(shape, count, self.sites[shape]) for shape, count in self.shapes.most_common()
+                if count > threshold]
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'queries' in g:
+        g.queries.add(statement)
+
+
+def install():
+    import sqlalchemy as sa
+    sa.event.listen(sa.engine.Engine, 'before_cursor_execute', _before_cursor_execute)
+
+
+def start():
+    g.queries = RequestQueries()
+
+
+def over_budget():
+    """Message when the current request issued more queries than its
+    endpoint's budget, otherwise None"""
+    queries = g.get('queries')
+    if queries is None:
+        return
+    budget = settings.QUERY_BUDGETS.get(request.endpoint, settings.QUERY_BUDGET_DEFAULT)
+    if budget is not None and queries.count > budget:
+        return f'{request.endpoint}: {queries.count} queries for {request.full_path}, budget is {budget}'
+
+
+def finish(res):
+    """Report repeated statement shapes (likely N+1 lazy loads) and
+    check the endpoint's query budget. Raises QueryBudgetExceeded
+    with QUERY_TRACKER_STRICT, logs otherwise."""
+    msg = over_budget()
+    queries = g.pop('queries', None)
+    if queries is None:
+        return res
+
+    res.headers['X-Query-Count'] = str(queries.count)
+    for shape, count, site in queries.repeated(settings.QUERY_REPEAT_THRESHOLD):
+        current_app.logger.warning(f'{request.endpoint}: statement repeated {count}x from {site}: {shape[:300]}')
+
+    if msg:
+        if settings.QUERY_TRACKER_STRICT:
+            raise QueryBudgetExceeded(msg)
+        current_app.logger.warning(msg)
+    return res
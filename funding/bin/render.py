@@ -0,0 +1,110 @@
+import hashlib
+import re
+
+import markdown2
+from markupsafe import escape
+
+import settings
+from funding.bin.anti_xss import such_xss
+
+# bump whenever the output of `render` changes (sanitizer or markdown
+# options, markdown2 upgrades), then run `flask render-proposals`
+RENDERER_VERSION = 1
+
+
+def render_key(content):
+    """Identifies the html `render` produces for this content"""
+    blob = f'{RENDERER_VERSION}:{content}'
+    return hashlib.sha256(blob.encode()).hexdigest()
+
+
+def render(content):
+    """Proposal markdown to sanitized html, uncached"""
+    return markdown2.markdown(such_xss(content), safe_mode=True)
+
+
+def render_cached(content, key=None):
+    """`render`, memoized in Redis by `render_key`"""
+    from funding.factory import cache
+
+    cache_key = 'markdown_%s' % (key or render_key(content))
+    html = cache.get(cache_key)
+    if html is None:
+        html = render(content)
+        cache.set(cache_key, html, timeout=settings.MARKDOWN_CACHE_TIMEOUT)
+    return html
+
+
+_regex_url = re.compile(r'(https?://[^\s<>"\']+)')
+_regex_img = re.compile(r'https://i\.(imgur|imgflip)\.com/[a-zA-Z0-9]{1,7}\.(jpg|png|gif|webm)')
+
+
+def _render_url(url):
+    if _regex_img.fullmatch(url):
+        return '<img src="%s"/>' % escape(url)
+    return '<a href="%s" rel="nofollow noopener" target="_blank">%s</a>' % (escape(url), escape(url))
+
+
+def render_comment(message):
+    """
+    Comment text to html, done once when the comment is saved: the text
+    is escaped, lines are joined with <br>, URLs become links (imgur and
+    imgflip images become <img>) and lines starting with `>` are quotes.
+    """
+    lines = []
+    for line in message.strip().split('\r\n'):
+        if not line:
+            continue
+        parts = _regex_url.split(line)
+        # odd parts are the URLs captured by the split
+        html = ''.join(_render_url(part) if i % 2 else str(escape(part))
+                       for i, part in enumerate(parts))
+        if line.startswith('>'):
+            html = '<span class="quote">%s</span>' % html
+        lines.append(html)
+    return '<br>\n'.join(lines)
+
+
+def _render(item):
+    # runs in a worker process; the parent writes the result, so
+    # no database connections are shared across the fork
+    pid, content = item
+    try:
+        return pid, render_key(content), render(content)
+    except Exception:
+        return pid, None, None
+
+
+def rerender_proposals(processes=None, force=False):
+    """
+    Re-render the html of all proposals that were rendered by another
+    renderer version (or all of them, with `force`) across a process pool.
+    :return: (rendered, skipped, failed, seconds)
+    """
+    import multiprocessing
+    import time
+    from funding.factory import db
+    from funding.orm import Proposal
+
+    proposals = {p.id: p for p in Proposal.query.all()}
+    todo = [(p.id, p.content) for p in proposals.values()
+            if force or p.render_key != render_key(p.content)]
+    skipped = len(proposals) - len(todo)
+
+    start = time.time()
+    rendered = failed = 0
+    if todo:
+        with multiprocessing.Pool(processes) as pool:
+            for pid, key, html in pool.imap_unordered(_render, todo, chunksize=8):
+                if key is None:
+                    failed += 1
+                    continue
+                proposals[pid].html = html
+                proposals[pid].render_key = key
+                rendered += 1
+        try:
+            db.session.commit()
+        except:
+            db.session.rollback()
+            raise
+    return rendered, skipped, failed, time.time() - start
@@ -0,0 +1,98 @@
+import math
+import random
+import time
+import uuid
+from functools import wraps
+
+from funding.factory import app, cache
+
+
+def single_flight(key, timeout, lease=10, stale=None, beta=1.0):
+    """
+    Cache decorator that keeps concurrent cache misses from all
+    recomputing the same value:
+
+    - only the worker holding a Redis lock (`lock_<key>`, expires after
+      `lease` seconds) recomputes; the others keep serving the stored
+      value, for up to `stale` seconds (default: `timeout`) past expiry.
+    - the value is refreshed early with a probability that grows towards
+      expiry, scaled by how long it took to compute (XFetch), so hot keys
+      are usually refreshed before they expire at all.
+    - on a cold miss, the other workers wait up to `lease` seconds for
+      the lock holder's result instead of computing it as well; when the
+      lock is released without a result, one of them takes over.
+    - when the recompute fails and a stale value exists, that is served.
+
+    Deleting `key` from the cache invalidates as usual.
+    :param key: cache key, or a callable building it from the arguments
+    """
+    stale = timeout if stale is None else stale
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            cache_key = key(*args, **kwargs) if callable(key) else key
+            lock_key = f'lock_{cache_key}'
+            token = uuid.uuid4().hex
+
+            entry = cache.get(cache_key)
+            if not isinstance(entry, tuple) or len(entry) != 3:
+                entry = None  # missing, or stored by a plain @cache.cached
+
+            if entry is not None:
+                value, delta, expiry = entry
+                # XFetch: -log(u) is mostly small, sometimes large
+                if time.time() - delta * beta * math.log(1 - random.random()) < expiry:
+                    return value
+                if not cache.add(lock_key, token, timeout=lease):
+                    return value
+            elif not cache.add(lock_key, token, timeout=lease):
+                deadline = time.time() + lease
+                while True:
+                    time.sleep(0.05)
+                    entry = cache.get(cache_key)
+                    if isinstance(entry, tuple) and len(entry) == 3:
+                        return entry[0]
+                    if time.time() > deadline:
+                        # the lock holder is stuck; compute without the lock
+                        return func(*args, **kwargs)
+                    # released without a result (the recompute failed): take over
+                    if cache.get(lock_key) is None and cache.add(lock_key, token, timeout=lease):
+                        entry = None
+                        break
+
+            try:
+                start = time.time()
+                result = func(*args, **kwargs)
+                delta = time.time() - start
+                cache.set(cache_key, (result, delta, time.time() + timeout), timeout=timeout + stale)
+                return result
+            except Exception as ex:
+                if entry is None:
+                    raise
+                app.logger.warning(f'serving stale {cache_key}: {ex}')
+                return entry[0]
+            finally:
+                release(lock_key, token)
+        return wrapper
+    return decorator
+
+
+# deletes the lock only while it still holds our token, in one step
+_release_script = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+def release(lock_key, token):
+    """Drop the lock, unless it expired and was taken by someone else"""
+    backend = cache.cache
+    if hasattr(backend, '_write_client'):
+        backend._write_client.eval(_release_script, 1, backend._get_prefix() + lock_key,
+                                   backend.serializer.dumps(token))
+    elif cache.get(lock_key) == token:
+        # backends without scripting (e.g. SimpleCache): not atomic
+        cache.delete(lock_key)
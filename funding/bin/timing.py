@@ -0,0 +1,146 @@
+import json
+import logging
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import g, has_request_context, request
+
+import settings
+
+# SERVER_TIMING_LOG lines; flask's app logger drops INFO unless DEBUG is on
+log = logging.getLogger('funding.timing')
+
+# backend methods timed as `cache`
+CACHE_METHODS = ('get', 'set', 'add', 'delete', 'has', 'get_many', 'set_many',
+                 'delete_many', 'get_dict', 'inc', 'dec', 'clear')
+
+
+class RequestTiming:
+    """Time spent per category during one request"""
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.totals = OrderedDict()
+
+    def add(self, name, seconds):
+        total = self.totals.setdefault(name, [0.0, 0])
+        total[0] += seconds
+        total[1] += 1
+
+    def server_timing(self):
+        """Value for the Server-Timing header; durations in ms"""
+        parts = ['%s;dur=%.1f;desc="%d calls"' % (name, seconds * 1000, count)
+                 for name, (seconds, count) in self.totals.items()]
+        parts.append('total;dur=%.1f' % ((time.perf_counter() - self.start) * 1000))
+        return ', '.join(parts)
+
+    def as_dict(self):
+        data = {name: {'ms': round(seconds * 1000, 1), 'calls': count}
+                for name, (seconds, count) in self.totals.items()}
+        data['total'] = {'ms': round((time.perf_counter() - self.start) * 1000, 1)}
+        return data
+
+
+def record(name, seconds):
+    if has_request_context() and 'timing' in g:
+        g.timing.add(name, seconds)
+
+
+def timed(name, func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            record(name, time.perf_counter() - start)
+    return wrapper
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('timing_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    record('sql', time.perf_counter() - conn.info['timing_start'].pop())
+
+
+def _handle_error(context):
+    if context.connection is not None and context.connection.info.get('timing_start'):
+        context.connection.info['timing_start'].pop()
+
+
+def _before_render_template(sender, template, context, **extra):
+    g.setdefault('timing_render', []).append(time.perf_counter())
+
+
+def _template_rendered(sender, template, context, **extra):
+    # includes lazy loads and cache lookups done by the template
+    record('render', time.perf_counter() - g.timing_render.pop())
+
+
+def _send(send):
+    rpc = {settings.RPC_LOCATION, settings.RPC_LOCATION_DEVFUND}
+
+    @wraps(send)
+    def wrapper(self, prepared, **kwargs):
+        start = time.perf_counter()
+        try:
+            return send(self, prepared, **kwargs)
+        finally:
+            record('rpc' if prepared.url in rpc else 'http', time.perf_counter() - start)
+    return wrapper
+
+
+def install(app, cache):
+    """Hook the timers into SQLAlchemy, `requests`, the cache backend
+    and template rendering. Only done when SERVER_TIMING is enabled."""
+    import requests
+    import sqlalchemy as sa
+    from flask import before_render_template, template_rendered
+
+    sa.event.listen(sa.engine.Engine, 'before_cursor_execute', _before_cursor_execute)
+    sa.event.listen(sa.engine.Engine, 'after_cursor_execute', _after_cursor_execute)
+    sa.event.listen(sa.engine.Engine, 'handle_error', _handle_error)
+
+    requests.Session.send = _send(requests.Session.send)
+
+    backend = cache.cache
+    for method in CACHE_METHODS:
+        if hasattr(backend, method):
+            setattr(backend, method, timed('cache', getattr(backend, method)))
+
+    before_render_template.connect(_before_render_template, app)
+    template_rendered.connect(_template_rendered, app)
+
+    if settings.SERVER_TIMING_LOG and not log.handlers:
+        # one JSON line per request on stderr (gunicorn's error log),
+        # unless logging was configured for `funding.timing` already
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        log.addHandler(handler)
+        log.setLevel(logging.INFO)
+        log.propagate = False
+
+
+def start():
+    g.timing = RequestTiming()
+
+
+def finish(res):
+    """Add the Server-Timing header and, with SERVER_TIMING_LOG, log
+    the breakdown as a JSON line"""
+    timing = g.pop('timing', None)
+    if timing is None:
+        return res
+
+    res.headers['Server-Timing'] = timing.server_timing()
+    if settings.SERVER_TIMING_LOG:
+        log.info(json.dumps({
+            'method': request.method,
+            'path': request.path,
+            'endpoint': request.endpoint,
+            'status': res.status_code,
+            'timing': timing.as_dict()
+        }))
+    return res
@@ -1,9 +1,11 @@
-from datetime import datetime, date
+import hashlib
+from datetime import datetime, date, timezone
 
 import requests
-from flask import request
+from flask import request, session, Response
 
 import settings
+from funding.bin.single_flight import single_flight
 from funding.factory import cache
 
 
@@ -15,46 +17,92 @@ def json_encoder(obj):
 
 class Summary:
     @staticmethod
-    @cache.cached(timeout=600, key_prefix="fetch_prices")
     def fetch_prices():
-        return {
-            'coin-btc': coin_btc_value(),
-            'btc-usd': price_cmc_btc_usd()
-        }
+        """Last known good prices plus their `age` in seconds, or None
+        before the first successful fetch. Never blocks on the price
+        feeds; see `funding.bin.prices.PriceOracle`."""
+        from funding.bin.prices import PriceOracle
+        return PriceOracle.get()
 
     @staticmethod
-    @cache.cached(timeout=600, key_prefix="funding_stats")
+    @single_flight("funding_stats", timeout=3600)
     def fetch_stats():
+        """Proposal counts per category and status, plus the user
+        count. Dropped from cache whenever a proposal or user write
+        that affects these numbers is committed."""
         from funding.factory import db
         from funding.orm import Proposal, User
 
-        data = {}
-        categories = settings.FUNDING_CATEGORIES
-        statuses = settings.FUNDING_STATUSES.keys()
-
-        for cat in categories:
-            q = db.session.query(Proposal)
-            q = q.filter(Proposal.category == cat)
-            res = q.count()
-            data.setdefault('cats', {})
-            data['cats'][cat] = res
-
-        for status in statuses:
-            q = db.session.query(Proposal)
-            q = q.filter(Proposal.status == status)
-            res = q.count()
-            data.setdefault('statuses', {})
-            data['statuses'][status] = res
-
-        data.setdefault('users', {})
-        data['users']['count'] = db.session.query(User.id).count()
+        data = {
+            'cats': {cat: 0 for cat in settings.FUNDING_CATEGORIES},
+            'statuses': {status: 0 for status in settings.FUNDING_STATUSES.keys()},
+            'users': {}
+        }
+
+        users = db.session.query(db.func.count(User.id)).as_scalar()
+        q = db.session.query(Proposal.category, Proposal.status, db.func.count(Proposal.id), users)
+        q = q.group_by(Proposal.category, Proposal.status)
+        rows = q.all()
+
+        for cat, status, count, _ in rows:
+            if cat in data['cats']:
+                data['cats'][cat] += count
+            if status in data['statuses']:
+                data['statuses'][status] += count
+
+        if rows:
+            data['users']['count'] = rows[0][3]
+        else:
+            data['users']['count'] = db.session.query(db.func.count(User.id)).scalar()
         return data
 
+    @staticmethod
+    def fetch_last_changes():
+        """Markers of the latest change to proposals, comments, users and
+        the ledger, for HTTP validators. Built from the `content_version`
+        and `ledger_version` cache keys, which are dropped on every such
+        write (see `invalidate_on_commit` and `funding.bin.ledger`);
+        no queries."""
+        from funding.orm import cache_version
+
+        versions = [cache_version('content_version'), cache_version('ledger_version')]
+        return {
+            'etag': make_etag(*versions),
+            # versions are first-read times, never earlier than the change
+            'last_modified': datetime.fromtimestamp(max(versions) / 1e9)
+        }
+
+    @staticmethod
+    @cache.cached(timeout=600, key_prefix="sidebar_data")
+    def fetch_sidebar():
+        """Recent comments and newest users, as plain dicts. Dropped
+        from cache whenever a comment or user is added."""
+        from funding.factory import db
+        from funding.orm import Comment, User
+
+        q = db.session.query(Comment.id, Comment.proposal_id, Comment.date_added, User.username)
+        q = q.join(User, Comment.user_id == User.id)
+        q = q.filter(Comment.automated == False)
+        q = q.order_by(Comment.date_added.desc())
+        q = q.limit(8)
+        recent_comments = [c._asdict() for c in q.all()]
+
+        q = db.session.query(User.username)
+        q = q.filter(User.admin == False)
+        q = q.order_by(User.registered_on.desc())
+        q = q.limit(5)
+        newest_users = [u._asdict() for u in q.all()]
+
+        return {
+            'recent_comments': recent_comments,
+            'newest_users': newest_users
+        }
+
 
 def price_cmc_btc_usd():
     headers = {'User-Agent': 'Mozilla/5.0 (Android 4.4; Mobile; rv:41.0) Gecko/41.0 Firefox/41.0'}
     try:
-        r = requests.get('https://api.coingecko.com/api/v3/coins/markets?vs_currency=usd', headers=headers)
+        r = requests.get(settings.PRICE_FEED_BTC_USD, headers=headers, timeout=settings.PRICE_FEED_TIMEOUT)
         r.raise_for_status()
         data = r.json()
         btc = next(c for c in data if c['symbol'] == 'btc')
@@ -66,7 +114,7 @@ def price_cmc_btc_usd():
 def coin_btc_value():
     headers = {'User-Agent': 'Mozilla/5.0 (Android 4.4; Mobile; rv:41.0) Gecko/41.0 Firefox/41.0'}
     try:
-        r = requests.get('https://tradeogre.com/api/v1/ticker/BTC-WOW', headers=headers)
+        r = requests.get(settings.PRICE_FEED_COIN_BTC, headers=headers, timeout=settings.PRICE_FEED_TIMEOUT)
         r.raise_for_status()
         return float(r.json().get('high'))
     except:
@@ -82,3 +130,44 @@ def coin_to_usd(amt: float, usd_per_btc: float, btc_per_coin: float):
 
 def get_ip():
     return request.headers.get('X-Forwarded-For') or request.remote_addr
+
+
+def make_etag(*parts):
+    return hashlib.sha1(':'.join(map(str, parts)).encode()).hexdigest()
+
+
+def not_modified(etag: str, last_modified: datetime = None):
+    """A 304 response when the client's validators (If-None-Match,
+    else If-Modified-Since) still match, otherwise None.
+    :param last_modified: naive local time, as stored in the database"""
+    if '_flashes' in session:
+        # pending flash messages still have to be rendered
+        return
+    from funding.bin.microcache import rendering
+    if rendering():
+        # the full page is rendered for the microcache, see microcache.lookup
+        return
+
+    if request.if_none_match:
+        if not request.if_none_match.contains(etag):
+            return
+    else:
+        since = request.if_modified_since
+        if not since or not last_modified:
+            return
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        if last_modified.astimezone(timezone.utc).replace(microsecond=0) > since:
+            return
+
+    return set_validators(Response(status=304), etag, last_modified)
+
+
+def set_validators(resp, etag: str, last_modified: datetime = None):
+    resp.set_etag(etag)
+    if last_modified:
+        resp.last_modified = last_modified.astimezone(timezone.utc)
+    # pages differ per logged in user; always revalidate
+    resp.headers['Cache-Control'] = 'no-cache'
+    resp.vary.add('Cookie')
+    return resp
@@ -1,28 +1,79 @@
 from flask import request
+from werkzeug.local import LocalProxy
 import settings
 from funding.bin.utils import Summary
-from funding.factory import app, db
-from funding.orm import User, Comment
+from funding.factory import app, cache
+
+if settings.SERVER_TIMING:
+    from funding.bin import timing
+    timing.install(app, cache)
+
+if settings.QUERY_TRACKER:
+    from funding.bin import query_tracker
+    query_tracker.install()
+
+if settings.METRICS_ENABLED:
+    from funding.bin import metrics
+    from funding.factory import db
+    metrics.install(cache, db)
+
+
+def sidebar():
+    """Sidebar data, fetched at most once per request. Kept in the
+    WSGI environ: `g` outlives the request, see create_app()"""
+    data = request.environ.get('funding.sidebar')
+    if data is None:
+        from funding.bin.utils_time import request_clock
+        data = Summary.fetch_sidebar()
+        time_magic = request_clock()
+        for c in data['recent_comments']:
+            c['ago'] = time_magic.ago(c['date_added'])
+        data['summary_data'] = Summary.fetch_stats()
+        request.environ['funding.sidebar'] = data
+    return data
 
 
 @app.context_processor
 def templating():
+    # the sidebar values are proxies, so pages that do
+    # not render the sidebar never fetch them
     from flask_login import current_user
-    recent_comments = db.session.query(Comment).filter(Comment.automated == False).order_by(Comment.date_added.desc()).limit(8).all()
-    summary_data = Summary.fetch_stats()
-    newest_users = db.session.query(User).filter(User.admin == False).order_by(User.registered_on.desc()).limit(5).all()
     return dict(logged_in=current_user.is_authenticated,
                 current_user=current_user,
                 funding_categories=settings.FUNDING_CATEGORIES,
                 funding_statuses=settings.FUNDING_STATUSES,
-                summary_data=summary_data,
-                recent_comments=recent_comments,
-                newest_users=newest_users)
+                summary_data=LocalProxy(lambda: sidebar()['summary_data']),
+                recent_comments=LocalProxy(lambda: sidebar()['recent_comments']),
+                newest_users=LocalProxy(lambda: sidebar()['newest_users']))
+
+
+@app.before_request
+def before_request_instrumentation():
+    # registered first, so the other hooks are included
+    if settings.METRICS_ENABLED:
+        metrics.start()
+    if settings.SERVER_TIMING:
+        timing.start()
+    if settings.QUERY_TRACKER:
+        query_tracker.start()
 
 
 @app.before_request
 def before_request():
-    pass
+    from funding.bin.microcache import lookup
+    return lookup()
+
+
+@app.after_request
+def after_request_instrumentation(res):
+    # registered first so it runs last, after the microcache stored the page
+    if settings.QUERY_TRACKER:
+        res = query_tracker.finish(res)
+    if settings.SERVER_TIMING:
+        res = timing.finish(res)
+    if settings.METRICS_ENABLED:
+        res = metrics.finish(res)
+    return res
 
 
 @app.after_request
@@ -40,6 +91,14 @@ def after_request(res):
     return res
 
 
+@app.after_request
+def after_request_microcache(res):
+    # registered last so it runs first, storing the page
+    # before the generic headers above are added
+    from funding.bin.microcache import store
+    return store(res)
+
+
 @app.errorhandler(404)
 def error(err):
     return 'Error', 404
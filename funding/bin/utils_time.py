@@ -5,31 +5,32 @@ import calendar
 
 
 class TimeMagic():
+    weekdays_en = {
+        0: 'monday',
+        1: 'tuesday',
+        2: 'wednesday',
+        3: 'thursday',
+        4: 'friday',
+        5: 'saturday',
+        6: 'sunday'
+    }
+    months_en = {
+        0: 'january',
+        1: 'february',
+        2: 'march',
+        3: 'april',
+        4: 'may',
+        5: 'june',
+        6: 'july',
+        7: 'august',
+        8: 'september',
+        9: 'october',
+        10: 'november',
+        11: 'december'
+    }
+
     def __init__(self):
         self.now = datetime.now()
-        self.weekdays_en = {
-            0: 'monday',
-            1: 'tuesday',
-            2: 'wednesday',
-            3: 'thursday',
-            4: 'friday',
-            5: 'saturday',
-            6: 'sunday'
-        }
-        self.months_en = {
-            0: 'january',
-            1: 'february',
-            2: 'march',
-            3: 'april',
-            4: 'may',
-            5: 'june',
-            6: 'july',
-            7: 'august',
-            8: 'september',
-            9: 'october',
-            10: 'november',
-            11: 'december'
-        }
 
     def get_weekday_from_datetime(self, dt):
         n = dt.today().weekday()
@@ -161,3 +162,16 @@ class TimeMagic():
                 if x == 1:
                     return '1 day ago'
                 return '%s days ago' % str(x)
+
+
+def request_clock():
+    """One TimeMagic per request, so all relative times on a page
+    share the same `now`. Kept in the WSGI environ: `g` outlives the
+    request, see create_app()"""
+    from flask import has_request_context, request
+    if not has_request_context():
+        return TimeMagic()
+    time_magic = request.environ.get('funding.time_magic')
+    if time_magic is None:
+        time_magic = request.environ['funding.time_magic'] = TimeMagic()
+    return time_magic
@@ -0,0 +1,150 @@
+import time
+
+import click
+
+import settings
+from funding.factory import app
+
+
+@app.cli.command('index-payments')
+@click.option('--loop', is_flag=True, help='keep running, every LEDGER_INDEX_INTERVAL seconds')
+def index_payments(loop):
+    """Index incoming proposal payments from wallet-rpc into the ledger.
+    Run from cron, or as a service with --loop."""
+    from funding.bin.ledger import index_payments
+
+    while True:
+        try:
+            amount = index_payments()
+            click.echo(f'indexed {amount} payments')
+        except Exception as ex:
+            if not loop:
+                raise
+            click.echo(f'error indexing payments: {ex}', err=True)
+
+        if not loop:
+            break
+        time.sleep(settings.LEDGER_INDEX_INTERVAL)
+
+
+@app.cli.command('reconcile-funds')
+@click.option('--loop', is_flag=True, help='keep running, every FUNDS_RECONCILE_INTERVAL seconds')
+def reconcile_funds(loop):
+    """Recompute the funding progress of all proposals from the ledger,
+    in one bulk update."""
+    from funding.bin.ledger import update_funds_progress
+
+    while True:
+        try:
+            changed = update_funds_progress()
+            click.echo(f'updated the funding progress of {len(changed)} proposals')
+        except Exception as ex:
+            if not loop:
+                raise
+            click.echo(f'error reconciling funds: {ex}', err=True)
+
+        if not loop:
+            break
+        time.sleep(settings.FUNDS_RECONCILE_INTERVAL)
+
+
+@app.cli.command('tx-notify')
+@click.argument('txid')
+def tx_notify(txid):
+    """Ingest a single transfer; usable as wallet-rpc's --tx-notify hook."""
+    from funding.bin.ledger import ingest_txid
+    proposal_ids = ingest_txid(txid)
+    click.echo(f'{txid}: proposals {sorted(proposal_ids)}')
+
+
+@app.cli.command('address-pool')
+@click.option('--loop', is_flag=True, help='keep running, every ADDRESS_POOL_INTERVAL seconds')
+def address_pool(loop):
+    """Top up the integrated address pool to ADDRESS_POOL_WATERMARK."""
+    from funding.bin.address_pool import top_up
+
+    while True:
+        try:
+            created = top_up()
+            click.echo(f'created {created} integrated addresses')
+        except Exception as ex:
+            if not loop:
+                raise
+            click.echo(f'error topping up address pool: {ex}', err=True)
+
+        if not loop:
+            break
+        time.sleep(settings.ADDRESS_POOL_INTERVAL)
+
+
+@app.cli.command('search-reindex')
+def search_reindex():
+    """Rebuild the full-text search document of all proposals.
+    Needed once after adding the column to an existing database:
+    ALTER TABLE proposals ADD COLUMN search_vector tsvector;
+    CREATE INDEX ix_proposals_search_vector ON proposals USING gin (search_vector);"""
+    from funding.orm import Proposal
+    Proposal.update_search_vectors()
+    click.echo('done')
+
+
+@app.cli.command('refresh-prices')
+def refresh_prices():
+    """Fetch the price feeds now, instead of waiting for a request
+    to find them stale."""
+    from funding.bin.prices import PriceOracle
+    for key, value in PriceOracle.refresh().items():
+        click.echo(f"{key}: {value['value']} (updated {int(time.time() - value['updated'])}s ago)")
+
+
+@app.cli.command('qr-generate')
+@click.option('--processes', type=int, default=None, help='worker processes, defaults to the CPU count')
+def qr_generate(processes):
+    """Pre-render QR codes for all donation and receiving addresses
+    that are not in the QR store yet."""
+    from funding.bin.qr import pregenerate
+    from funding.factory import db
+    from funding.orm import Proposal
+
+    addresses = []
+    for addr_donation, addr_receiving in db.session.query(Proposal.addr_donation, Proposal.addr_receiving):
+        addresses += [addr_donation, addr_receiving]
+
+    rendered, skipped, seconds = pregenerate(addresses, processes=processes)
+    rate = rendered / seconds if seconds else 0
+    click.echo(f'rendered {rendered} QR codes in {seconds:.1f}s ({rate:.1f}/s), skipped {skipped} existing')
+
+
+@app.cli.command('render-proposals')
+@click.option('--processes', type=int, default=None, help='worker processes, defaults to the CPU count')
+@click.option('--force', is_flag=True, help='also re-render proposals rendered by the current renderer version')
+def render_proposals(processes, force):
+    """Re-render the html of proposals after a RENDERER_VERSION bump.
+    Needed once after adding the column to an existing database:
+    ALTER TABLE proposals ADD COLUMN render_key VARCHAR(64);"""
+    from funding.bin.render import rerender_proposals
+
+    rendered, skipped, failed, seconds = rerender_proposals(processes=processes, force=force)
+    click.echo(f'rendered {rendered} proposals in {seconds:.1f}s, skipped {skipped} up to date, {failed} failed')
+
+
+@app.cli.command('render-comments')
+@click.option('--force', is_flag=True, help='also re-render comments that already have html')
+def render_comments(force):
+    """Render the stored html of comments saved before it existed.
+    Needed once after adding the column to an existing database:
+    ALTER TABLE comments ADD COLUMN html VARCHAR;"""
+    from funding.bin.render import render_comment
+    from funding.factory import db
+    from funding.orm import Comment
+
+    q = db.session.query(Comment)
+    if not force:
+        q = q.filter(Comment.html.is_(None))
+
+    rendered = 0
+    for comment in q.yield_per(500):
+        comment.html = render_comment(comment.message)
+        rendered += 1
+    db.session.commit()
+    click.echo(f'rendered {rendered} comments')
@@ -29,6 +29,12 @@ def _setup_cache(app: Flask):
     app.config.from_mapping(cache_config)
     cache = Cache(app)
 
+    if settings.NEAR_CACHE_SIZE:
+        from funding.bin.near_cache import NearCache
+        near_cache = NearCache(settings.NEAR_CACHE_KEYS, maxsize=settings.NEAR_CACHE_SIZE,
+                               ttl=settings.NEAR_CACHE_TTL, channel=cache_config["CACHE_KEY_PREFIX"] + "near_cache")
+        near_cache.install(cache)
+
 
 def _setup_session(app: Flask):
     app.config['SESSION_TYPE'] = 'redis'
@@ -88,6 +94,8 @@ def create_app():
     # import routes
     from funding import routes
     from funding import api
+    from funding import internal
+    from funding import cli
     from funding.bin import utils_request
 
     app.app_context().push()
@@ -0,0 +1,49 @@
+import hmac
+
+from flask import Response, request
+from flask_yoloapi import endpoint, parameter
+
+import settings
+from funding.factory import app
+
+
+@app.route('/internal/tx-notify', methods=['GET', 'POST'])
+@endpoint.api(
+    parameter('txid', type=str, location='args', required=True),
+    parameter('token', type=str, location='args', required=True)
+)
+def internal_tx_notify(txid, token):
+    """
+    Called by wownero-wallet-rpc for every incoming transfer:
+    --tx-notify "/usr/bin/curl -s http://127.0.0.1:5004/internal/tx-notify?token=<TX_NOTIFY_TOKEN>&txid=%s"
+    :param txid: the transfer announced by the wallet
+    :param token: shared secret, TX_NOTIFY_TOKEN
+    :return: ids of the proposals that received funds
+    """
+    from funding.bin.ledger import ingest_txid
+
+    if not settings.TX_NOTIFY_TOKEN or not hmac.compare_digest(token, settings.TX_NOTIFY_TOKEN):
+        return Response('Error', 404)
+
+    return sorted(ingest_txid(txid))
+
+
+@app.route('/internal/metrics')
+def internal_metrics():
+    """
+    Prometheus metrics of all workers. Scrape with
+    `bearer_token: <METRICS_TOKEN>`.
+    """
+    from funding.bin.metrics import generate
+
+    token = ''
+    auth = request.headers.get('Authorization', '')
+    if auth.startswith('Bearer '):
+        token = auth[7:]
+
+    if not settings.METRICS_ENABLED or not settings.METRICS_TOKEN or \
+            not hmac.compare_digest(token, settings.METRICS_TOKEN):
+        return Response('Error', 404)
+
+    data, content_type = generate()
+    return Response(data, content_type=content_type)
@@ -1,17 +1,19 @@
 from datetime import datetime
 import string
 import random
+import time
 
-import requests
-from sqlalchemy.orm import relationship, backref
+from markupsafe import Markup, escape
+from sqlalchemy.orm import relationship, backref, joinedload, deferred
 import sqlalchemy as sa
 from sqlalchemy.orm import scoped_session, sessionmaker, relationship
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.dialects.postgresql import UUID, TSVECTOR
 from sqlalchemy.types import Float
 from sqlalchemy_json import MutableJson
 
 import settings
+from funding.bin.single_flight import single_flight
 from funding.factory import db, cache
 
 base = declarative_base(name="Model")
@@ -75,6 +77,7 @@ class User(db.Model):
             db.session.add(user)
             db.session.commit()
             db.session.flush()
+            cache.delete('sidebar_data')
             return user
         except Exception as ex:
             db.session.rollback()
@@ -90,6 +93,8 @@ class Proposal(db.Model):
     category = db.Column(db.VARCHAR, nullable=False)
     date_added = db.Column(db.TIMESTAMP, default=datetime.now)
     html = db.Column(db.VARCHAR)
+    # `funding.bin.render.render_key` of the content `html` was rendered from
+    render_key = db.Column(db.VARCHAR(64))
     last_edited = db.Column(db.TIMESTAMP)
 
     # the FFS target
@@ -119,6 +124,12 @@ class Proposal(db.Model):
 
     payouts = relationship("Payout", back_populates="proposal")
     comments = relationship("Comment", back_populates="proposal", lazy='select')
+    transactions = relationship("Transaction", back_populates="proposal")
+
+    # full-text search document, maintained on insert/update
+    search_vector = deferred(db.Column(TSVECTOR))
+
+    __table_args__ = (db.Index('ix_proposals_search_vector', 'search_vector', postgresql_using='gin'),)
 
     def __init__(self, headline, content, category, user: User):
         if not headline or not content:
@@ -150,6 +161,7 @@ class Proposal(db.Model):
     def find_by_id(cls, pid: int):
         from funding.factory import db
         q = cls.query
+        q = q.options(joinedload(Proposal.user))
         q = q.filter(Proposal.id == pid)
         result = q.first()
         if not result:
@@ -166,29 +178,78 @@ class Proposal(db.Model):
 
     @property
     def comment_count(self):
+        if hasattr(self, '_comment_count'):
+            return self._comment_count
+
         from funding.factory import db
         q = db.session.query(db.func.count(Comment.id))
         q = q.filter(Comment.proposal_id == self.id)
-        return q.scalar()
+        setattr(self, '_comment_count', q.scalar())
+        return self._comment_count
+
+    @staticmethod
+    def load_comment_counts(proposals: list):
+        """Attach `comment_count` to a list of proposals with
+        one aggregated query, instead of a COUNT per proposal"""
+        from funding.factory import db
+        if not proposals:
+            return proposals
+
+        q = db.session.query(Comment.proposal_id, db.func.count(Comment.id))
+        q = q.filter(Comment.proposal_id.in_([p.id for p in proposals]))
+        q = q.group_by(Comment.proposal_id)
+        counts = dict(q.all())
+
+        for p in proposals:
+            setattr(p, '_comment_count', counts.get(p.id, 0))
+        return proposals
 
     def get_comments(self):
+        """Loads the complete comment thread, including authors, in a
+        single query and builds the reply tree in memory. Top-level
+        comments end up in `self._comments` (newest first), replies
+        in `comment.comments` (oldest first), at any depth."""
         from funding.factory import db
         q = db.session.query(Comment)
+        q = q.options(joinedload(Comment.user))
         q = q.filter(Comment.proposal_id == self.id)
-        q = q.filter(Comment.replied_to.is_(None))
-        q = q.order_by(Comment.date_added.desc())
+        q = q.order_by(Comment.date_added)
         comments = q.all()
 
+        by_id = {c.id: c for c in comments}
+        for c in comments:
+            setattr(c, 'comments', [])
+
+        roots = []
         for c in comments:
-            q = db.session.query(Comment)
-            q = q.filter(Comment.proposal_id == self.id)
-            q = q.filter(Comment.replied_to == c.id)
-            _c = q.all()
-            setattr(c, 'comments', _c)
+            if c.replied_to is None:
+                roots.append(c)
+            elif c.replied_to in by_id:
+                by_id[c.replied_to].comments.append(c)
 
-        setattr(self, '_comments', comments)
+        setattr(self, '_comments', list(reversed(roots)))
         return self
 
+    @property
+    def comment_tree(self):
+        """Top-level comments, loaded on first access"""
+        if not hasattr(self, '_comments'):
+            self.get_comments()
+        return self._comments
+
+    @staticmethod
+    def version_key(pid: int):
+        return f"proposal_version_{pid}"
+
+    @property
+    def version(self):
+        """Opaque value that changes whenever anything shown on the
+        proposal page changes (edits, comments, payments, payouts).
+        Bumped by deleting the key; see `invalidate_on_commit`."""
+        if not hasattr(self, '_version'):
+            setattr(self, '_version', cache_version(Proposal.version_key(self.id)))
+        return self._version
+
     @property
     def spends(self):
         amount = sum([p.amount for p in self.payouts])
@@ -196,12 +257,14 @@ class Proposal(db.Model):
         return {"amount": amount, "pct": pct}
 
     @property
-    @cache.cached(timeout=60, make_cache_key=lambda p: f"proposal_balance_{p.id}")
+    @single_flight(lambda p: f"proposal_balance_{p.id}", timeout=60)
     def balance(self):
         """This property retrieves the current funding status
-        of this proposal. It uses Redis cache to not spam the
-        daemon too much. Returns a nice dictionary containing
-        all relevant proposal funding info"""
+        of this proposal from the transactions ledger, which is
+        kept up to date by the payment indexer. Returns a nice
+        dictionary containing all relevant proposal funding info.
+        Read-only: `funds_progress` is maintained by
+        `funding.bin.ledger.update_funds_progress`."""
         from funding.bin.utils import Summary, coin_to_usd
         from funding.factory import db
         rtn = {'sum': 0.0, 'txs': [], 'pct': 0.0, 'available': 0}
@@ -209,39 +272,17 @@ class Proposal(db.Model):
         if self.archived:
             return rtn
 
-        try:
-            r = requests.get(f'http://{settings.RPC_HOST}:{settings.RPC_PORT}/json_rpc', json={
-                "jsonrpc": "2.0",
-                "id": "0",
-                "method": "get_payments",
-                "params": {
-                    "payment_id": self.payment_id
-                }
-            })
-            r.raise_for_status()
-            blob = r.json()
-
-            assert 'result' in blob
-            assert 'payments' in blob['result']
-            assert isinstance(blob['result']['payments'], list)
-        except Exception as ex:
-            return rtn
-
-        txs = blob['result']['payments']
-        for tx in txs:
-            tx['amount_human'] = float(tx['amount'])/1e11
-            tx['txid'] = tx['tx_hash']
-            tx['type'] = 'in'
+        q = db.session.query(Transaction)
+        q = q.filter(Transaction.proposal_id == self.id)
+        q = q.order_by(Transaction.block_height, Transaction.id)
+        txs = [tx.as_tx for tx in q.all()]
 
+        # unconfirmed (pool) transfers are listed, but not counted
         data = {
-            'sum': sum([float(z['amount']) / 1e11 for z in txs]),
+            'sum': sum([tx['amount_human'] for tx in txs if tx['type'] == 'in']),
             'txs': txs
         }
 
-        if not isinstance(data, dict):
-            print('error; get_transfers_in; %d' % self.id)
-            return rtn
-
         prices = Summary.fetch_prices()
         for tx in data['txs']:
             if prices:
@@ -254,11 +295,6 @@ class Proposal(db.Model):
             data['pct'] = 0.0
             data['available'] = 0.0
 
-        if data['pct'] != self.funds_progress:
-            self.funds_progress = data['pct']
-            db.session.commit()
-            db.session.flush()
-
         if data['available']:
             data['remaining_pct'] = 100 / float(data['sum'] / data['available'])
         else:
@@ -274,6 +310,7 @@ class Proposal(db.Model):
             raise NotImplementedError('invalid cat')
 
         q = cls.query
+        q = q.options(joinedload(Proposal.user))
         if isinstance(status, int):
             q = q.filter(Proposal.status == status)
         if cat:
@@ -283,16 +320,103 @@ class Proposal(db.Model):
         if isinstance(offset, int):
             q = q.offset(offset)
 
-        return q.all()
+        return cls.load_comment_counts(q.all())
+
+    @staticmethod
+    def search_document(headline, content):
+        """tsvector SQL expression; headline ranks above content"""
+        headline = db.func.setweight(db.func.to_tsvector(settings.SEARCH_LANGUAGE, headline), 'A')
+        content = db.func.setweight(db.func.to_tsvector(settings.SEARCH_LANGUAGE, content), 'B')
+        return headline.op('||')(content)
 
     @classmethod
-    def search(cls, key: str):
-        key_ilike = f"%{key.replace('%', '')}%"
-        q = Proposal.query
-        q = q.filter(db.or_(
-            Proposal.headline.ilike(key_ilike),
-            Proposal.content.ilike(key_ilike)))
-        return q.all()
+    def search(cls, key: str, limit: int = 20, offset: int = 0):
+        """Full-text search, ordered by relevance. Every result
+        gets a `snippet` with the matched words highlighted."""
+        query = db.func.plainto_tsquery(settings.SEARCH_LANGUAGE, key)
+        rank = db.func.ts_rank_cd(Proposal.search_vector, query)
+        snippet = db.func.ts_headline(settings.SEARCH_LANGUAGE, Proposal.content, query,
+                                      'StartSel="\x02", StopSel="\x03", MaxWords=35, MinWords=15')
+
+        q = db.session.query(Proposal, snippet)
+        q = q.options(joinedload(Proposal.user))
+        q = q.filter(Proposal.search_vector.op('@@')(query))
+        q = q.order_by(rank.desc(), Proposal.date_added.desc())
+        q = q.limit(limit).offset(offset)
+
+        results = []
+        for p, _snippet in q.all():
+            _snippet = escape(_snippet)
+            _snippet = _snippet.replace('\x02', Markup('<mark>')).replace('\x03', Markup('</mark>'))
+            setattr(p, 'snippet', _snippet)
+            results.append(p)
+        return cls.load_comment_counts(results)
+
+    @staticmethod
+    def update_search_vectors():
+        """(Re)build the search document of all proposals"""
+        from funding.factory import db
+        q = db.session.query(Proposal)
+        try:
+            q.update({Proposal.search_vector: Proposal.search_document(Proposal.headline, Proposal.content)},
+                     synchronize_session=False)
+            db.session.commit()
+            db.session.flush()
+        except:
+            db.session.rollback()
+            raise
+
+
+@sa.event.listens_for(Proposal, 'before_insert')
+@sa.event.listens_for(Proposal, 'before_update')
+def proposal_search_vector(mapper, connection, target):
+    state = sa.inspect(target)
+    if state.persistent and not (state.attrs.headline.history.has_changes() or
+                                 state.attrs.content.history.has_changes()):
+        return
+    target.search_vector = Proposal.search_document(target.headline, target.content)
+
+
+def cache_version(key: str):
+    """Opaque version stored under `key`: the time (in ns) it was first
+    read after the key was last dropped. Bump it by deleting the key."""
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, time.time_ns(), timeout=0)
+        version = cache.get(key)
+    return version
+
+
+def invalidate_on_commit(session, *keys):
+    """Drop these cache keys once the session's transaction commits"""
+    session.info.setdefault('cache_invalidate', set()).update(keys)
+
+
+@sa.event.listens_for(db.session, 'after_commit')
+def cache_invalidate(session):
+    for key in session.info.pop('cache_invalidate', set()):
+        cache.delete(key)
+
+
+@sa.event.listens_for(db.session, 'after_rollback')
+def cache_invalidate_discard(session):
+    session.info.pop('cache_invalidate', None)
+
+
+@sa.event.listens_for(Proposal, 'after_insert')
+@sa.event.listens_for(Proposal, 'after_delete')
+@sa.event.listens_for(User, 'after_insert')
+@sa.event.listens_for(User, 'after_delete')
+def funding_stats_changed(mapper, connection, target):
+    invalidate_on_commit(sa.orm.object_session(target), 'funding_stats', 'content_version')
+
+
+@sa.event.listens_for(Proposal, 'after_update')
+def funding_stats_proposal_changed(mapper, connection, target):
+    state = sa.inspect(target)
+    if state.attrs.category.history.has_changes() or state.attrs.status.history.has_changes():
+        invalidate_on_commit(state.session, 'funding_stats')
+    invalidate_on_commit(state.session, Proposal.version_key(target.id), 'content_version')
 
 
 class Payout(db.Model):
@@ -342,6 +466,127 @@ class Payout(db.Model):
         }
 
 
+class Transaction(db.Model):
+    """Incoming payment to a proposal's integrated address, as
+    indexed from wallet-rpc by `funding.bin.ledger`"""
+    __tablename__ = "transactions"
+    id = db.Column(db.Integer, primary_key=True)
+
+    proposal_id = db.Column(db.Integer, db.ForeignKey('proposals.id'), nullable=False)
+    proposal = relationship("Proposal", back_populates="transactions")
+
+    txid = db.Column(db.VARCHAR, nullable=False)
+    payment_id = db.Column(db.VARCHAR, nullable=False)
+
+    # atomic units
+    amount = db.Column(db.BigInteger, nullable=False)
+    block_height = db.Column(db.Integer, nullable=False, default=0)
+
+    date_added = db.Column(db.TIMESTAMP, default=datetime.now)
+
+    __table_args__ = (db.UniqueConstraint('txid', 'payment_id', name='uq_transaction_txid_payment_id'),)
+    ix_transaction_proposal_id = db.Index("ix_transaction_proposal_id", proposal_id)
+
+    @property
+    def as_tx(self):
+        return {
+            "block_height": self.block_height,
+            "type": "in" if self.block_height else "pool",
+            "txid": self.txid,
+            "amount_human": float(self.amount) / 1e11,
+            "amount": self.amount
+        }
+
+
+class LedgerCursor(db.Model):
+    """Highest block height the payment indexer has processed"""
+    __tablename__ = "ledger_cursors"
+    name = db.Column(db.VARCHAR, primary_key=True)
+    height = db.Column(db.Integer, nullable=False, default=0)
+
+    @staticmethod
+    def get(name: str):
+        from funding.factory import db
+        cursor = db.session.query(LedgerCursor).filter(LedgerCursor.name == name).first()
+        if not cursor:
+            cursor = LedgerCursor(name=name, height=0)
+            db.session.add(cursor)
+        return cursor
+
+
+class IntegratedAddress(db.Model):
+    """Pre-generated integrated address / payment id pair, kept topped
+    up by `flask address-pool` and claimed by new proposals"""
+    __tablename__ = "address_pool"
+    id = db.Column(db.Integer, primary_key=True)
+
+    address = db.Column(db.VARCHAR, nullable=False, unique=True)
+    payment_id = db.Column(db.VARCHAR, nullable=False, unique=True)
+    claimed = db.Column(db.Boolean, nullable=False, default=False)
+
+    date_added = db.Column(db.TIMESTAMP, default=datetime.now)
+
+    ix_address_pool_claimed = db.Index("ix_address_pool_claimed", claimed)
+
+    @staticmethod
+    def available():
+        from funding.factory import db
+        q = db.session.query(db.func.count(IntegratedAddress.id))
+        q = q.filter(IntegratedAddress.claimed.is_(False))
+        return q.scalar()
+
+    @staticmethod
+    def claim():
+        """Atomically claim an unused pair with a single UPDATE. Part of
+        the current transaction, so a rollback releases it again.
+        :return: (address, payment_id) or None when the pool is empty"""
+        from funding.factory import db
+        table = IntegratedAddress.__table__
+
+        sub = db.select([table.c.id])
+        sub = sub.where(table.c.claimed.is_(False))
+        sub = sub.order_by(table.c.id).limit(1)
+        sub = sub.with_for_update(skip_locked=True).as_scalar()
+
+        stmt = table.update().where(table.c.id == sub).values(claimed=True)
+        stmt = stmt.returning(table.c.address, table.c.payment_id)
+        row = db.session.execute(stmt).first()
+        if not row:
+            return
+        return row.address, row.payment_id
+
+
+class QrImage(db.Model):
+    """Rendered QR code, for `QR_STORE = 'postgres'`"""
+    __tablename__ = "qr_images"
+    key = db.Column(db.VARCHAR, primary_key=True)
+    data = db.Column(db.LargeBinary, nullable=False)
+    date_added = db.Column(db.TIMESTAMP, default=datetime.now)
+
+    @staticmethod
+    def get(key: str):
+        from funding.factory import db
+        return db.session.query(QrImage.data).filter(QrImage.key == key).scalar()
+
+    @staticmethod
+    def exists(key: str):
+        from funding.factory import db
+        return db.session.query(db.exists().where(QrImage.key == key)).scalar()
+
+    @staticmethod
+    def add(key: str, data: bytes):
+        from funding.factory import db
+        from sqlalchemy.dialects.postgresql import insert
+        stmt = insert(QrImage.__table__).values(key=key, data=data, date_added=datetime.now())
+        stmt = stmt.on_conflict_do_nothing(index_elements=['key'])
+        try:
+            db.session.execute(stmt)
+            db.session.commit()
+        except:
+            db.session.rollback()
+            raise
+
+
 class Comment(db.Model):
     __tablename__ = "comments"
     id = db.Column(db.Integer, primary_key=True)
@@ -355,6 +600,8 @@ class Comment(db.Model):
     date_added = db.Column(db.TIMESTAMP, default=datetime.now)
 
     message = db.Column(db.VARCHAR, nullable=False)
+    # `message` rendered by `funding.bin.render.render_comment` on save
+    html = db.Column(db.VARCHAR)
     replied_to = db.Column(db.ForeignKey("comments.id"))
 
     locked = db.Column(db.Boolean, default=False)
@@ -366,12 +613,17 @@ class Comment(db.Model):
 
     @property
     def message_html(self):
-        return [line for line in self.message.strip().split('\r\n') if line]
+        html = self.html
+        if html is None:
+            # not backfilled yet, see `flask render-comments`
+            from funding.bin.render import render_comment
+            html = render_comment(self.message)
+        return Markup(html)
 
     @property
     def ago(self):
-        from funding.bin.utils_time import TimeMagic
-        return TimeMagic().ago(self.date_added)
+        from funding.bin.utils_time import request_clock
+        return request_clock().ago(self.date_added)
 
     @staticmethod
     def find_by_id(cid: int):
@@ -446,11 +698,27 @@ class Comment(db.Model):
             except:
                 raise Exception("unknown error")
         try:
+            from funding.bin.render import render_comment
             comment.message = message
+            comment.html = render_comment(message)
             db.session.add(comment)
             db.session.commit()
             db.session.flush()
         except Exception as ex:
             db.session.rollback()
             raise Exception(str(ex))
+        cache.delete('sidebar_data')
         return comment
+
+
+@sa.event.listens_for(Comment, 'after_insert')
+@sa.event.listens_for(Comment, 'after_update')
+@sa.event.listens_for(Comment, 'after_delete')
+@sa.event.listens_for(Payout, 'after_insert')
+@sa.event.listens_for(Payout, 'after_update')
+@sa.event.listens_for(Payout, 'after_delete')
+def proposal_version_changed(mapper, connection, target):
+    session = sa.orm.object_session(target)
+    invalidate_on_commit(session, 'content_version')
+    if target.proposal_id:
+        invalidate_on_commit(session, Proposal.version_key(target.proposal_id))
@@ -9,7 +9,10 @@ from flask_yoloapi import endpoint, parameter
 
 import settings
 from funding.factory import app, db, cache
-from funding.orm import Proposal, User, Comment
+from funding.bin.daemon import Daemon
+from funding.bin.render import render_key, render_cached
+from funding.bin.utils import Summary, make_etag, not_modified, set_validators
+from funding.orm import Proposal, User, Comment, IntegratedAddress
 
 
 @app.route('/')
@@ -67,7 +70,7 @@ def proposal_comment(pid, text, cid):
 def propsal_comment_reply(cid, pid):
     from funding.orm import Comment
     c = Comment.find_by_id(cid)
-    if not c or c.replied_to:
+    if not c:
         return redirect(url_for('proposal', pid=pid))
     p = Proposal.find_by_id(pid)
     if not p:
@@ -83,8 +86,19 @@ def proposal(pid):
     p = Proposal.find_by_id(pid=pid)
     if not p:
         return make_response(redirect(url_for('proposals')))
-    p.get_comments()
-    return make_response(render_template(('proposal/proposal.html'), proposal=p))
+
+    changes = Summary.fetch_last_changes()
+    etag = make_etag('proposal', p.id, p.last_edited, p.version, changes['etag'], current_user.get_id())
+    resp = not_modified(etag, changes['last_modified'])
+    if resp:
+        return resp
+
+    # sections are fragment-cached per proposal version, comments
+    # and balance are only loaded when a fragment is rendered
+    resp = make_response(render_template(('proposal/proposal.html'), proposal=p,
+                                         version=p.version,
+                                         fragment_timeout=settings.FRAGMENT_CACHE_TIMEOUT))
+    return set_validators(resp, etag, changes['last_modified'])
 
 
 @app.route('/api/proposal/add', methods=['POST'])
@@ -98,8 +112,6 @@ def proposal(pid):
     parameter('status', type=int, required=True, location='json', default=1)
 )
 def proposal_api_add(title, content, pid, funds_target, addr_receiving, category, status):
-    import markdown2
-
     if current_user.is_anonymous:
         return make_response(jsonify('err'), 500)
 
@@ -118,13 +130,7 @@ def proposal_api_add(title, content, pid, funds_target, addr_receiving, category
     if status != 1 and not current_user.admin:
         return make_response(jsonify('no rights to change status'), 500)
 
-    try:
-        from funding.bin.anti_xss import such_xss
-        content_escaped = such_xss(content)
-        html = markdown2.markdown(content_escaped, safe_mode=True)
-    except Exception as ex:
-        return make_response(jsonify('markdown error'), 500)
-
+    key = render_key(content)
     if pid:
         p = Proposal.find_by_id(pid=pid)
         if not p:
@@ -133,9 +139,20 @@ def proposal_api_add(title, content, pid, funds_target, addr_receiving, category
         if p.user.id != current_user.id and not current_user.admin:
             return make_response(jsonify('no rights to edit this proposal'), 500)
 
+    # edits that leave the content alone (status, category) keep the html
+    if pid and p.render_key == key:
+        html = p.html
+    else:
+        try:
+            html = render_cached(content, key)
+        except Exception as ex:
+            return make_response(jsonify('markdown error'), 500)
+
+    if pid:
         p.headline = title
         p.content = content
         p.html = html
+        p.render_key = key
         if addr_receiving:
             p.addr_receiving = addr_receiving
         if category:
@@ -163,38 +180,34 @@ def proposal_api_add(title, content, pid, funds_target, addr_receiving, category
 
         p = Proposal(headline=title, content=content, category='misc', user=current_user)
         p.html = html
+        p.render_key = key
         p.last_edited = datetime.now()
         p.funds_target = funds_target
         p.addr_receiving = addr_receiving
         p.category = category
         p.status = status
 
-        # generate integrated address
-        try:
-            r = requests.get(f'http://{settings.RPC_HOST}:{settings.RPC_PORT}/json_rpc', json={
-                "jsonrpc": "2.0",
-                "id": "0",
-                "method": "make_integrated_address"
-            })
-            r.raise_for_status()
-            blob = r.json()
-
-            assert 'result' in blob
-            assert 'integrated_address' in blob['result']
-            assert 'payment_id' in blob['result']
-        except Exception as ex:
-            raise
+        # claim a pre-generated integrated address, only fall
+        # back to wallet-rpc when the pool ran dry
+        claimed = IntegratedAddress.claim()
+        if not claimed:
+            try:
+                blob = Daemon().make_integrated_address()
+                claimed = blob['integrated_address'], blob['payment_id']
+            except Exception as ex:
+                db.session.rollback()
+                return make_response(jsonify('could not generate a donation address, try again later'), 500)
 
-        p.addr_donation = blob['result']['integrated_address']
-        p.payment_id = blob['result']['payment_id']
+        p.addr_donation, p.payment_id = claimed
 
         db.session.add(p)
 
     db.session.commit()
     db.session.flush()
 
-    # reset cached stuffz
-    cache.delete('funding_stats')
+    if not pid:
+        from funding.bin.qr import QrCodeGenerator
+        QrCodeGenerator.create_async(p.addr_donation)
 
     return make_response(jsonify({'url': url_for('proposal', pid=p.id)}))
 
@@ -210,13 +223,19 @@ def proposal_edit(pid):
 
 @app.route('/search')
 @endpoint.api(
-    parameter('key', type=str, required=False)
+    parameter('key', type=str, required=False),
+    parameter('page', type=int, location='args', required=False)
 )
-def search(key=None):
+def search(key=None, page=None):
     if not key:
         return make_response(render_template('search.html', results=None, key='Empty!'))
-    results = Proposal.search(key=key)
-    return make_response(render_template('search.html', results=results, key=key))
+
+    page = max(page or 1, 1)
+    per_page = settings.SEARCH_RESULTS_PER_PAGE
+    results = Proposal.search(key=key, limit=per_page + 1, offset=(page - 1) * per_page)
+    has_next = len(results) > per_page
+    return make_response(render_template('search.html', results=results[:per_page], key=key,
+                                         page=page, has_next=has_next))
 
 
 @app.route('/user/<path:name>')
@@ -234,6 +253,12 @@ def user(name):
     parameter('cat', type=str, location='args', required=False)
 )
 def proposals(status, page, cat):
+    changes = Summary.fetch_last_changes()
+    etag = make_etag('proposals', status, page, cat, changes['etag'], current_user.get_id())
+    resp = not_modified(etag, changes['last_modified'])
+    if resp:
+        return resp
+
     if not isinstance(status, int) and not isinstance(page, int) and not cat:
         # no args, render overview
         proposals = {
@@ -241,7 +266,8 @@ def proposals(status, page, cat):
             'funding': Proposal.find_by_args(status=2, limit=10),
             'wip': Proposal.find_by_args(status=3, limit=10),
             'completed': Proposal.find_by_args(status=4, limit=10)}
-        return make_response(render_template('proposal/overview.html', proposals=proposals))
+        resp = make_response(render_template('proposal/overview.html', proposals=proposals))
+        return set_validators(resp, etag, changes['last_modified'])
 
     try:
         if not isinstance(status, int):
@@ -250,8 +276,9 @@ def proposals(status, page, cat):
     except:
         return make_response(redirect(url_for('proposals')))
 
-    return make_response(render_template('proposal/proposals.html',
+    resp = make_response(render_template('proposal/proposals.html',
                                          proposals=proposals, status=status, cat=cat))
+    return set_validators(resp, etag, changes['last_modified'])
 
 
 @app.route('/donate')
@@ -295,7 +322,6 @@ def register():
     try:
         user = User.add(username, password, email)
         flash('Successfully registered. No confirmation email required. You can login!')
-        cache.delete('funding_stats')  # reset cached stuffz
         return redirect(url_for('login'))
     except Exception as ex:
         flash('Could not register user. Probably a duplicate username or email that already exists.', 'error')